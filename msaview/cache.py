@@ -1,61 +1,208 @@
-class CacheItem(object):
-    def __init__(self, key, value):
+import threading
+
+def get_nbytes(value):
+    """Return the approximate memory footprint of a cached value, or 0."""
+    try:
+        # cairo image surfaces.
+        return value.get_stride() * value.get_height()
+    except AttributeError:
+        pass
+    # numpy arrays.
+    return getattr(value, 'nbytes', 0)
+
+class LinkNode(object):
+    __slots__ = ['prev', 'next']
+
+class LinkedList(object):
+    """Doubly linked list of nodes, most recently used first. All operations are O(1)."""
+    def __init__(self):
+        self.root = LinkNode()
+        self.clear()
+    
+    def clear(self):
+        self.root.prev = self.root.next = self.root
+    
+    def push_front(self, node):
+        node.prev = self.root
+        node.next = self.root.next
+        self.root.next.prev = node
+        self.root.next = node
+    
+    def unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+        node.prev = node.next = None
+    
+    def move_to_front(self, node):
+        self.unlink(node)
+        self.push_front(node)
+    
+    def last(self):
+        node = self.root.prev
+        if node is self.root:
+            return None
+        return node
+
+class CacheItem(LinkNode):
+    __slots__ = ['key', 'value', 'nbytes', 'cache', 'budget_node']
+    def __init__(self, key, value, cache=None):
         self.key = key
-        self.hash = hash(key)
         self.value = value
+        self.nbytes = get_nbytes(value)
+        self.cache = cache
+        self.budget_node = None
+
+class BudgetNode(LinkNode):
+    __slots__ = ['item']
+    def __init__(self, item):
+        self.item = item
+
+class CacheBudget(object):
+    """Memory budget shared by several caches.
+    
+    When the values in all the caches together take up more than max_bytes,
+    the least recently used items are evicted, from whichever cache holds 
+    them. Caches sharing a budget also share its lock.
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.n_items = 0
+        self.order = LinkedList()
+        self.lock = threading.RLock()
+    
+    def add(self, item):
+        item.budget_node = BudgetNode(item)
+        self.order.push_front(item.budget_node)
+        self.nbytes += item.nbytes
+        self.n_items += 1
+    
+    def touch(self, item):
+        self.order.move_to_front(item.budget_node)
+    
+    def remove(self, item):
+        self.order.unlink(item.budget_node)
+        item.budget_node = None
+        self.nbytes -= item.nbytes
+        self.n_items -= 1
+    
+    def shrink(self):
+        while (self.max_bytes is not None and self.nbytes > self.max_bytes and 
+               self.n_items > 1):
+            item = self.order.last().item
+            item.cache.evict(item.key)
+
+# Shared by the caches that hold surfaces for display, such as fragments, 
+# renderer layers, glyphs and labels.
+cache_budget = CacheBudget(max_bytes=384 * 2**20)
         
 class Cache(object):
+    """Least recently used cache, limited by item count and optionally bytes.
+    
+    Lookups, insertions and evictions are O(1). If the cache is given a 
+    CacheBudget, items may also be evicted to keep within that.
+    """
     size = 100
-    def __init__(self):
-        self.items = []
+    max_bytes = None
+    def __init__(self, size=None, max_bytes=None, budget=None):
+        self.items = {}
+        self.order = LinkedList()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if size is not None:
+            self.size = size
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.budget = budget
+        if budget is None:
+            self.lock = threading.RLock()
+        else:
+            self.lock = budget.lock
 
     def __contains__(self, key):
-        try:
-            self.index(key)
-        except KeyError:
-            return False
-        return True
+        return key in self.items
     
     def __delitem__(self, key):
-        self.items.pop(self.index(key))
+        with self.lock:
+            self._remove(self.items[key])
 
     def __getitem__(self, key):
-        i = self.index(key)
-        item = self.items.pop(i)
-        self.items.insert(0, item) 
-        return item.value
+        with self.lock:
+            try:
+                item = self.items[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            self.order.move_to_front(item)
+            if self.budget is not None:
+                self.budget.touch(item)
+            return item.value
     
     def __len__(self):
         return len(self.items)
     
     def __setitem__(self, key, value):
-        try:
-            i = self.index(key)
-        except KeyError:
-            pass
-        else:
-            self.items.pop(i)
-        self.items.insert(0, CacheItem(key, value)) 
-        if len(self.items) > self.size:
-            self.items.pop()
-
-    def index(self, key):
-        h = hash(key)
-        for i, item in enumerate(self.items):
-            if item.hash == h and item.key == key:
-                return i
-        raise KeyError(key)
+        with self.lock:
+            old = self.items.get(key)
+            if old is not None:
+                self._remove(old)
+            item = CacheItem(key, value, self)
+            self.items[key] = item
+            self.order.push_front(item)
+            self.nbytes += item.nbytes
+            if self.budget is not None:
+                self.budget.add(item)
+            while len(self.items) > 1 and (len(self.items) > self.size or 
+                                           self.max_bytes is not None and self.nbytes > self.max_bytes):
+                self.evict(self.order.last().key)
+            if self.budget is not None:
+                self.budget.shrink()
+
+    def _remove(self, item):
+        del self.items[item.key]
+        self.order.unlink(item)
+        self.nbytes -= item.nbytes
+        if self.budget is not None:
+            self.budget.remove(item)
+        
+    def evict(self, key):
+        """Drop key to make room, counting it as an eviction."""
+        with self.lock:
+            self._remove(self.items[key])
+            self.evictions += 1
         
     def flush(self):
-        self.items = []
+        with self.lock:
+            if self.budget is not None:
+                for item in self.items.values():
+                    self.budget.remove(item)
+            self.items = {}
+            self.order.clear()
+            self.nbytes = 0
     
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
-            return default
-    
-    def peek(self, key):
-        i = self.index(key)
-        return self.items[i].value
-    
\ No newline at end of file
+        """Return the value for key, or default if it is not cached."""
+        with self.lock:
+            try:
+                return self[key]
+            except KeyError:
+                return default
+    
+    def peek(self, key, default=None):
+        """Return the value for key without counting it as used, or default."""
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return default
+            return item.value
+
+    def get_stats(self):
+        """Return a dict of counters, for tuning cache sizes."""
+        return dict(items=len(self.items),
+                    nbytes=self.nbytes,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions)
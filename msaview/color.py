@@ -11,9 +11,9 @@ from preset import (Setting,
 
 class Color(object):
     def __init__(self, r, g, b, a=1.0):
-        r, g, b, a = [int(n)/255.0 if n > 1 else int(n*255.0)/255.0 for n in [r, g, b, a]]
+        r, g, b, a = [int(n)/255.0 if n > 1 else int(round(n*255.0))/255.0 for n in [r, g, b, a]]
         self.rgba = [r, g, b, a]
-        self.array = numpy.array([int(n*255) for n in [b, g, r, a]], numpy.uint8)
+        self.array = numpy.array([int(round(n*255)) for n in [b, g, r, a]], numpy.uint8)
         self.r = r
         self.g = g
         self.b = b
@@ -51,6 +51,12 @@ class Color(object):
         n = 65535.0
         return cls(c.red/n, c.green/n, c.blue/n, alpha)
 
+    @classmethod
+    def from_array(cls, array):
+        """Make a Color from a BGRA uint8 array, like Color.array."""
+        b, g, r, a = [v / 255.0 for v in array.tolist()]
+        return cls(r, g, b, a)
+
     def with_alpha(self, alpha):
         r, g, b, a = self.rgba
         return Color(r, g, b, a * alpha)
@@ -312,9 +318,13 @@ def blend(amount, color1, color2):
     return Color(*args)
 
 class Gradient(object):
+    # Number of colors in the lookup table used by map_array().
+    lut_size = 1024
+    
     def __init__(self):
         self.colorstops = []
         self.settings = None
+        self._lut = None
         
     def __hash__(self):
         return hash(tuple(self.colorstops))
@@ -382,6 +392,38 @@ class Gradient(object):
             ratio = (offset - offset1) / (offset2 - offset1)
             return numpy.array(ratio * color2.array + (1 - ratio) * color1.array, dtype=numpy.uint8)
     
+    def get_lut(self):
+        """Return (start, stop, lut) for the gradient baked into a lookup table.
+        
+        lut is a (lut_size, 4) uint8 array of BGRA colors, evenly spaced from 
+        the first colorstop offset (start) to the last (stop). 
+        """
+        if self._lut is None or self._lut[0] != self.colorstops:
+            offsets = numpy.array([o for o, c in self.colorstops])
+            colors = numpy.array([c.array for o, c in self.colorstops], float)
+            samples = numpy.linspace(offsets[0], offsets[-1], self.lut_size)
+            lut = numpy.empty((self.lut_size, 4), numpy.uint8)
+            for channel in range(4):
+                lut[:,channel] = numpy.round(numpy.interp(samples, offsets, colors[:,channel]))
+            self._lut = (list(self.colorstops), offsets[0], offsets[-1], lut)
+        return self._lut[1:]
+    
+    def map_array(self, values):
+        """Return BGRA colors for an array of offsets, shaped values.shape + (4,)."""
+        values = numpy.asarray(values, float)
+        if not self.colorstops:
+            return numpy.zeros(values.shape + (4,), numpy.uint8)
+        start, stop, lut = self.get_lut()
+        if stop > start:
+            indices = numpy.round((values - start) * ((len(lut) - 1) / (stop - start)))
+        else:
+            indices = numpy.where(values < start, 0, len(lut) - 1)
+        return lut.take(indices.astype(int), axis=0, mode='clip')
+    
+    def get_colors_from_offsets(self, offsets):
+        """Return a list of Colors for a sequence of offsets, via map_array()."""
+        return [Color.from_array(a) for a in self.map_array(offsets)]
+    
     def to_linear_gradient(self, x0, y0, x1, y1):
         g = cairo.LinearGradient(x0, y0, x1, y1)
         for offset, color in self.colorstops:
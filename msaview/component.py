@@ -1,3 +1,4 @@
+import itertools
 import re
 
 import gobject
@@ -30,6 +31,13 @@ class Change(object):
             aspects = [aspects]
         return ALL_ASPECTS_CHANGED in self.aspects or self.aspects.intersection(aspects)
 
+# Generation numbers are drawn from one sequence shared by all components, so
+# that no two states of any two components ever get the same number.
+_generations = itertools.count(1)
+
+def _bump_generation(component, change):
+    component.generation = _generations.next()
+
 class Connection(object):
     def __init__(self, source, id):
         self.source = source
@@ -92,6 +100,8 @@ class Component(gobject.GObject):
         self.connections = {}
         self.propvalues = {}
         self.fromsettings = None
+        self.generation = _generations.next()
+        self.connect('changed', _bump_generation)
         self.reset()
     
     def do_get_property(self, pspec):
@@ -111,6 +121,13 @@ class Component(gobject.GObject):
             return
         self.propvalues[name] = value
     
+    def get_cache_key(self):
+        """Return a key for the current state of the component.
+        
+        The key changes every time the component emits 'changed'.
+        """
+        return (id(self), self.generation)
+    
     def update_change_handlers(self, **kw):
         for name, source in kw.items():
             try:
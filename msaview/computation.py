@@ -16,12 +16,13 @@ gobject.threads_init()
 from preset import NamespaceIgnorantXMLTreeBuilder
 
 class ComputeJob(object):
-    def __init__(self, source_id, fcn, args=None):
+    def __init__(self, source_id, fcn, args=None, can_block=False):
         if args is None:
             args = ()
         self.source_id = source_id
         self.fcn = fcn
         self.args = args
+        self.can_block = can_block
 
 class BackgroundTask(gobject.GObject):
     __gsignals__ = dict(
@@ -38,6 +39,10 @@ class BackgroundTask(gobject.GObject):
             (gobject.TYPE_STRING, # one of 'error' or 'abort' 
              gobject.TYPE_PYOBJECT, # error data (any type of object) or None. 
              )))
+    # Set if process(block=True) finishes the task in one call, waiting 
+    # for any worker thread instead of polling it.
+    can_block = False
+    
     def __init__(self):
         gobject.GObject.__init__(self)
         self._abort = False
@@ -76,23 +81,27 @@ class ComputeManager(object):
         return wrapper
         
     def idle_add(self, fcn, *args, **kw):
+        can_block = False
         if isinstance(fcn, BackgroundTask):
+            can_block = fcn.can_block
             fcn = fcn.process
         counter = self.counter
         fcn = self._wrap(fcn, counter)
         source_id = gobject.idle_add(fcn, *args, **kw)
-        job = ComputeJob(source_id, fcn, args)
+        job = ComputeJob(source_id, fcn, args, can_block)
         self.jobs[counter] = job
         self.counter += 1
         return counter
         
     def timeout_add(self, interval, fcn, *args, **kw):
+        can_block = False
         if isinstance(fcn, BackgroundTask):
+            can_block = fcn.can_block
             fcn = fcn.process
         counter = self.counter
         fcn = self._wrap(fcn, counter)
         source_id = gobject.timeout_add(interval, fcn, *args, **kw)
-        job = ComputeJob(source_id, fcn, args)
+        job = ComputeJob(source_id, fcn, args, can_block)
         self.jobs[counter] = job
         self.counter += 1
         return counter
@@ -110,7 +119,10 @@ class ComputeManager(object):
     def compute_all(self):
         while self.jobs:
             for id, job in self.jobs.items():
-                job.fcn(*job.args)
+                if job.can_block:
+                    job.fcn(*job.args, block=True)
+                else:
+                    job.fcn(*job.args)
 
     def abort_all(self):
         for id, job in self.jobs.items():
@@ -1,3 +1,4 @@
+import bisect
 import itertools
 
 import gobject
@@ -96,6 +97,98 @@ def map_region_to_msa(region, msa_positions, offset=0):
         i += 1
     return mapped or None
 
+def feature_interval(feature):
+    return feature.mapping.start, feature.mapping.start + feature.mapping.length
+
+class IntervalIndex(object):
+    """A list of items sorted on interval start, for fast overlap queries.
+    
+    Alongside the start and stop of each item, the index keeps a running 
+    maximum of stops. Items before the first one whose running maximum 
+    reaches past the query start cannot overlap the query, so queries only
+    look at a short stretch of the list found by bisection.
+    
+    interval is a function returning (start, stop) for an item, where stop
+    is exclusive.
+    """
+    def __init__(self, items=None, interval=feature_interval):
+        self.interval = interval
+        self.items = []
+        self.starts = []
+        self.stops = []
+        self.max_stops = []
+        if items:
+            self.add(items)
+        
+    def __iter__(self):
+        return iter(self.items)
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def __getitem__(self, i):
+        return self.items[i]
+    
+    def __contains__(self, item):
+        start, stop = self.interval(item)
+        lo = bisect.bisect_left(self.starts, start)
+        hi = bisect.bisect_right(self.starts, start, lo)
+        return item in self.items[lo:hi]
+    
+    def _update(self, first=0):
+        if first == 0:
+            self.starts = []
+            self.stops = []
+            self.max_stops = []
+        else:
+            del self.starts[first:], self.stops[first:], self.max_stops[first:]
+        max_stop = self.max_stops[-1] if self.max_stops else None
+        for item in self.items[first:]:
+            start, stop = self.interval(item)
+            if max_stop is None or stop > max_stop:
+                max_stop = stop
+            self.starts.append(start)
+            self.stops.append(stop)
+            self.max_stops.append(max_stop)
+    
+    def add(self, items):
+        """Insert items, keeping the index sorted on start."""
+        if len(items) == 1:
+            start, stop = self.interval(items[0])
+            i = bisect.bisect_right(self.starts, start)
+            self.items.insert(i, items[0])
+            self._update(i)
+            return
+        self.items.extend(items)
+        self.items.sort(key=lambda item: self.interval(item)[0])
+        self._update()
+    
+    def remove(self, items):
+        """Remove items. Raises ValueError if any of them are not present."""
+        if len(items) == 1:
+            start, stop = self.interval(items[0])
+            i = bisect.bisect_left(self.starts, start)
+            i += self.items[i:bisect.bisect_right(self.starts, start, i)].index(items[0])
+            del self.items[i]
+            self._update(i)
+            return
+        doomed = set(items)
+        kept = [item for item in self.items if item not in doomed]
+        if len(self.items) - len(kept) != len(doomed):
+            raise ValueError('cannot remove items not in the index')
+        self.items = kept
+        self._update()
+        
+    def overlapping(self, start, stop):
+        """Return the items whose intervals overlap [start, stop), in order."""
+        hi = bisect.bisect_left(self.starts, stop)
+        lo = bisect.bisect_right(self.max_stops, start, 0, hi)
+        return [self.items[i] for i in range(lo, hi) if self.stops[i] > start]
+    
+    def at(self, position):
+        """Return the items whose intervals contain position, in order."""
+        return self.overlapping(position, position + 1)
+
 class SequenceFeature(object):
     def __init__(self, sequence_index=None, sequence_id=None, source=None, name=None, region=None, mapping=None, description=None):
         self.sequence_index = sequence_index
@@ -136,6 +229,16 @@ class SequenceFeature(object):
         except:
             return False
     
+    def get_annotation_key(self):
+        """Return a key that is the same for features that are equal()."""
+        description = self.description
+        if description is not None:
+            try:
+                description = description.lower()
+            except AttributeError:
+                pass
+        return (self.source.lower(), self.name.lower(), description)
+    
     def equal(self, other):
         if isinstance(other, self.__class__):
             return self.is_similarly_annotated(other)
@@ -256,44 +359,50 @@ class SequenceFeatureRegistry(Component):
         if change.has_changed('sequences'):
             self.clear()
         
-    def find(self, test, sequence_index=None):
+    def _iter_features(self, sequence_index=None, position=None):
+        if sequence_index is None:
+            indices = self.features
+        else:
+            indices = [self.features[sequence_index]]
+        if position is None:
+            return itertools.chain(*indices)
+        return itertools.chain(*[index.at(position) for index in indices])
+        
+    def find(self, test, sequence_index=None, position=None):
+        """Return the first feature that passes test, or None.
+        
+        test can also be a category name. The search can be restricted to
+        one sequence and/or to features covering an msa position.
+        """
         if isinstance(test, str):
             category = test
             test = lambda e: e.category == category
-        if sequence_index is None:
-            it = itertools.chain(*self.features)
-        else:
-            it = self.features[sequence_index]
-        for entry in it:
+        for entry in self._iter_features(sequence_index, position):
             if test(entry):
                 return entry
              
-    def findall(self, test, sequence_index=None):
+    def findall(self, test, sequence_index=None, position=None):
+        """Return all features that pass test. Arguments are as for find()."""
         if isinstance(test, str):
             category = test
             test = lambda e: e.category == category
-        features = []
-        if sequence_index is None:
-            it = itertools.chain(*self.features)
-        else:
-            it = self.features[sequence_index]
-        for entry in it:
-            if test(entry):
-                features.append(entry)
-        return features
+        return [entry for entry in self._iter_features(sequence_index, position) if test(entry)]
         
     def remove_features(self, features):
         if isinstance(features, SequenceFeature):
             features = [features]
+        doomed = {}
         for entry in features:
-            self.features[entry.sequence_index].remove(entry)
+            doomed.setdefault(entry.sequence_index, []).append(entry)
+        for sequence_index, l in doomed.items():
+            self.features[sequence_index].remove(l)
         self.emit('changed', Change('features', 'removed', features))
    
     def clear(self):
         l = []
         if self.msa:
             l = self.msa.sequences
-        self.features = [list() for x in l]
+        self.features = [IntervalIndex() for x in l]
         self.emit('changed', Change('features'))
         
     def integrate(self, ancestor, name=None):
@@ -309,18 +418,16 @@ class SequenceFeatureRegistry(Component):
     def add_features(self, features):
         if isinstance(features, SequenceFeature):
             features = [features]
-        new_features = []
+        new_features = {}
+        seen = set()
         for feature in features:
-            feature_list = self.features[feature.sequence_index]
-            for i, f in enumerate(feature_list):
-                if feature == f:
-                    break
-                if feature.mapping.start < f.mapping.start:
-                    feature_list.insert(i, feature)
-                    break
-            else:
-                feature_list.append(feature)
-                new_features.append(feature)
+            if feature in seen or feature in self.features[feature.sequence_index]:
+                continue
+            seen.add(feature)
+            new_features.setdefault(feature.sequence_index, []).append(feature)
+        for sequence_index, l in new_features.items():
+            self.features[sequence_index].add(l)
+        new_features = list(itertools.chain(*new_features.values()))
         if new_features:
             self.emit('changed', Change('features', 'added', new_features))
    
@@ -1,7 +1,13 @@
+import heapq
+import itertools
 import math
+import multiprocessing
 import os
+import Queue
 import re
 import sys
+import threading
+import time
 import traceback
 
 import cairo
@@ -13,7 +19,9 @@ from adjustments import ZoomAdjustment
 from component import (Component,
                        Root)
 from action import Coordinate
-from cache import Cache
+from cache import (Cache,
+                   cache_budget,
+                   get_nbytes)
 from preset import (ComponentSetting,
                     USER_PRESET_FILE,
                     presets,
@@ -35,18 +43,150 @@ from visualization import (Layout,
 
 
 class FragmentInfo(object):
-    def __init__(self, renderer, render_area):
+    def __init__(self, renderer, render_area, background=None):
         self.renderer = renderer
+        self.renderer_key = renderer.get_cache_key()
         self.render_area = render_area
+        self.background = background
         
     def __hash__(self):
-        return hash((FragmentInfo, self.renderer, self.render_area))
+        return hash((FragmentInfo, self.renderer_key, self.render_area))
     
     def __eq__(self, other):
         return (isinstance(other, self.__class__) and
-                other.renderer == self.renderer and 
+                other.renderer_key == self.renderer_key and 
                 other.render_area == self.render_area)
 
+class JobQueue(object):
+    """Priority queue of jobs stored under keys, lowest priority first.
+    
+    Pushing, reprioritizing and removing jobs are all O(log n). Replaced 
+    entries are left in the heap and skipped when popped.
+    """
+    _removed = object()
+    
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        
+    def __contains__(self, key):
+        return key in self.entries
+        
+    def __len__(self):
+        return len(self.entries)
+    
+    def keys(self):
+        return self.entries.keys()
+    
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        return entry[3]
+    
+    def push(self, key, job, priority):
+        """Queue job under key, replacing any job already queued there."""
+        self.remove(key)
+        entry = [priority, self.counter.next(), key, job]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+        if len(self.heap) > 2 * len(self.entries) + 100:
+            self.heap = [e for e in self.heap if e[2] is not self._removed]
+            heapq.heapify(self.heap)
+        
+    def reprioritize(self, key, priority):
+        self.push(key, self.entries[key][3], priority)
+    
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry[2] = self._removed
+        
+    def pop(self):
+        """Remove and return (key, job) for the job with the lowest priority."""
+        while self.heap:
+            priority, count, key, job = heapq.heappop(self.heap)
+            if key is not self._removed:
+                del self.entries[key]
+                return key, job
+        raise KeyError('pop from an empty job queue')
+    
+    def clear(self):
+        self.heap = []
+        self.entries.clear()
+        
+class RenderWorkers(object):
+    """Threads that render layers for thread safe renderers.
+    
+    Each layer is drawn on a private image surface through its own pango 
+    context. Finished layers are handed back on the main loop, by calling
+    the callback given to submit() with the layer, error traceback and the
+    seconds it took to render.
+    """
+    poll_interval = 20
+    
+    def __init__(self, n_threads=None):
+        if n_threads is None:
+            n_threads = multiprocessing.cpu_count()
+        self.tasks = Queue.PriorityQueue()
+        self.results = Queue.Queue()
+        self.outstanding = 0
+        self.counter = itertools.count()
+        self._poll_id = None
+        self.threads = []
+        for i in range(n_threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+    
+    def submit(self, priority, renderer, render_area, callback, wanted=None):
+        """Render a layer for render_area, unless wanted() says otherwise by then."""
+        self.outstanding += 1
+        self.tasks.put((priority, self.counter.next(), renderer, render_area, callback, wanted))
+        if self._poll_id is None:
+            self._poll_id = gobject.timeout_add(self.poll_interval, self.collect)
+    
+    def _work(self):
+        while True:
+            priority, count, renderer, render_area, callback, wanted = self.tasks.get()
+            layer = None
+            error = None
+            t = time.time()
+            if wanted is None or wanted():
+                try:
+                    layer = cairo.ImageSurface(cairo.FORMAT_ARGB32, render_area.width, render_area.height)
+                    with renderer.render_lock.reading():
+                        renderer.render(pangocairo.CairoContext(cairo.Context(layer)), render_area)
+                    layer.flush()
+                except Exception:
+                    layer = None
+                    error = traceback.format_exc()
+            self.results.put((callback, layer, error, time.time() - t))
+    
+    def collect(self):
+        while True:
+            try:
+                callback, layer, error, seconds = self.results.get_nowait()
+            except Queue.Empty:
+                break
+            self.outstanding -= 1
+            callback(layer, error, seconds)
+        if self.outstanding:
+            return True
+        self._poll_id = None
+        return False
+
+_render_workers = None
+
+def get_render_workers(n_threads=None):
+    """Return the render worker pool shared by all zoom views."""
+    global _render_workers
+    if _render_workers is None:
+        _render_workers = RenderWorkers(n_threads)
+    return _render_workers
+
 class PartialDrawManager(gobject.GObject):
     __gsignals__ = dict(
         fragment_updated = (
@@ -54,74 +194,260 @@ class PartialDrawManager(gobject.GObject):
             gobject.TYPE_NONE,
             (gobject.TYPE_INT, ) * 6))
     
-    def __init__(self, cache, pool=None):
+    # Memory budget for the per-renderer fragment layers.
+    layer_cache_bytes = 128 * 2**20
+    # Worker threads for slow, thread safe renderers. None for one per cpu, 
+    # or 0 to render everything on the main loop.
+    render_threads = None
+    
+    def __init__(self, cache, jobs=None, layer_cache=None, workers=None):
         gobject.GObject.__init__(self)
         self.cache = cache
-        if pool is None:
-            pool = []
-        self.pool = pool
+        if jobs is None:
+            jobs = JobQueue()
+        self.jobs = jobs
+        if layer_cache is None:
+            layer_cache = Cache(size=500, max_bytes=self.layer_cache_bytes, budget=cache_budget)
+        self.layer_cache = layer_cache
+        if workers is None and self.render_threads != 0:
+            workers = get_render_workers(self.render_threads)
+        self.workers = workers
+        self.pending_layers = {}
+        self.thread_failures = set()
+        # Running averages of seconds per pixel, by renderer class.
+        self.render_costs = {}
+        self.viewport = None
+        self._job_serial = itertools.count()
         self._idle_worker_id = None
         
+    def get_priority(self, render_area, serial):
+        """Visible jobs go first, then others at the same zoom level, and then
+        those at other levels, like prefetched zoom steps. Within each tier, 
+        jobs closest to the viewport centre go first, measured at the zoom 
+        level of the viewport. The newest jobs go first among equals.
+        """
+        viewport = self.viewport
+        if viewport is None:
+            return (0, 0, -serial)
+        xscale = float(viewport.total_width) / max(render_area.total_width, 1)
+        yscale = float(viewport.total_height) / max(render_area.total_height, 1)
+        dx = (render_area.x + render_area.width / 2.0) * xscale - (viewport.x + viewport.width / 2.0)
+        dy = (render_area.y + render_area.height / 2.0) * yscale - (viewport.y + viewport.height / 2.0)
+        if self.in_viewport(render_area):
+            tier = 0
+        elif xscale == yscale == 1:
+            tier = 1
+        else:
+            tier = 2
+        return (tier, dx * dx + dy * dy, -serial)
+    
+    def in_viewport(self, render_area):
+        viewport = self.viewport
+        if viewport is None:
+            return True
+        return (render_area.total_width == viewport.total_width and
+                render_area.total_height == viewport.total_height and
+                render_area.x < viewport.x + viewport.width and
+                viewport.x < render_area.x + render_area.width and
+                render_area.y < viewport.y + viewport.height and
+                viewport.y < render_area.y + render_area.height)
+    
+    def set_viewport(self, viewport):
+        """Reprioritize jobs around viewport.
+        
+        Jobs that left the view are kept at a lower priority, so that partly
+        drawn fragments get finished rather than started over when they come
+        back. Jobs for fragments that have been evicted from the fragment 
+        cache are dropped.
+        """
+        if viewport == self.viewport:
+            return
+        self.viewport = viewport
+        for fragment_info in self.jobs.keys():
+            if fragment_info not in self.cache:
+                self.jobs.remove(fragment_info)
+                continue
+            renderer_index, serial = self.jobs.get(fragment_info)
+            self.jobs.reprioritize(fragment_info, self.get_priority(fragment_info.render_area, serial))
+        
     def add_job(self, fragment_info, renderer_index):
-        if (fragment_info, renderer_index) in self.pool:
+        """Queue drawing of fragment_info from renderer_index on.
+        
+        A renderer_index of None means the fragment only shows a preview, 
+        and will be cleared and drawn again from scratch.
+        """
+        job = self.jobs.get(fragment_info)
+        if job is not None and job[0] == renderer_index:
             return
         if not self._idle_worker_id:
             self._idle_worker_id = gobject.idle_add(self.process_job)
-        self.pool.append((fragment_info, renderer_index))
+        serial = self._job_serial.next()
+        priority = self.get_priority(fragment_info.render_area, serial)
+        self.jobs.push(fragment_info, (renderer_index, serial), priority)
         
+    def draw_preview(self, cr, fragment_info, previous=None):
+        """Draw a fragment that appears while navigating, without any slow layers.
+        
+        If previous holds (surface, render_area) pairs for fragments of another
+        zoom level, those are scaled into place, and the fragment is redrawn 
+        in full from the job queue. Otherwise the fast layers are drawn right 
+        away, as by draw_partial, and only the slow ones are queued.
+        """
+        render_area = fragment_info.render_area
+        self.clear_fragment(cr, fragment_info)
+        if not previous:
+            self.draw_partial(cr, fragment_info)
+            return
+        for surface, area in previous:
+            xscale = float(render_area.total_width) / area.total_width
+            yscale = float(render_area.total_height) / area.total_height
+            cr.save()
+            cr.rectangle(0, 0, render_area.width, render_area.height)
+            cr.clip()
+            cr.translate(area.x * xscale - render_area.x, area.y * yscale - render_area.y)
+            cr.scale(xscale, yscale)
+            cr.set_source_surface(surface, 0, 0)
+            cr.paint()
+            cr.restore()
+        self.add_job(fragment_info, None)
+    
+    def clear_fragment(self, cr, fragment_info):
+        cr.save()
+        cr.set_operator(cairo.OPERATOR_SOURCE)
+        if fragment_info.background:
+            cr.set_source_rgba(*fragment_info.background.rgba)
+        else:
+            cr.set_source_rgba(0, 0, 0, 0)
+        cr.paint()
+        cr.restore()
+    
     def draw_partial(self, cr, fragment_info, renderer_index=None):
         render_area = fragment_info.render_area
         try:
-            renderers = fragment_info.renderer.renderers
-        except:
+            steps = fragment_info.renderer.get_render_steps(render_area)
+        except AttributeError:
             fragment_info.renderer.render(cr, render_area)
             return
         slow_job_done = False
-        for i in range(renderer_index or 0, len(renderers)):
-            r = renderers[i]
-            if r.get_slow_render(render_area):
+        for i, r in steps:
+            if i < (renderer_index or 0):
+                continue
+            key = (r.get_cache_key(), render_area)
+            if key not in self.layer_cache and r.get_slow_render(render_area):
+                if self.workers and r.thread_safe and key[0] not in self.thread_failures:
+                    self.request_layers(fragment_info, steps, i)
+                    return
                 if slow_job_done or renderer_index is None:
                     self.add_job(fragment_info, i)
                     return
                 slow_job_done = True
-            cr.save()
-            r.render(cr, render_area)
-            cr.restore()
+            self.draw_layer(cr, r, render_area, key)
             
-    def process_job(self):
-        fragment_info = None 
-        fragment_priority = None
-        renderer_index = None
-        job_index = None
-        i = 0
-        while i < len(self.pool):
-            frag, ri = self.pool[i]
-            try:
-                prio = self.cache.index(frag)
-            except KeyError:
-                del self.pool[i]
+    def request_layers(self, fragment_info, steps, index):
+        """Have the workers render the slow, thread safe layers from index on.
+        
+        Later layers are requested too so that they render in parallel. The
+        fragment is queued to resume drawing at index once that layer is done.
+        """
+        render_area = fragment_info.render_area
+        for i, r in steps:
+            if i < index or not r.thread_safe:
                 continue
-            if fragment_priority is None or prio < fragment_priority:
-                fragment_priority = prio
-                fragment_info = frag
-                renderer_index = ri
-                job_index = i
-            i += 1
-        if fragment_info is None:
+            key = (r.get_cache_key(), render_area)
+            if key[0] in self.thread_failures or key in self.layer_cache or not r.get_slow_render(render_area):
+                continue
+            waiting = self.pending_layers.get(key)
+            if waiting is None:
+                waiting = self.pending_layers[key] = []
+                self.submit_layer(key, r, render_area)
+            if i == index:
+                waiting.append((fragment_info, i))
+    
+    def submit_layer(self, key, renderer, render_area):
+        def wanted():
+            # Skip layers that no cached fragment is waiting for any more.
+            waiting = self.pending_layers.get(key)
+            return bool(waiting) and any(fragment_info in self.cache for fragment_info, i in waiting)
+        def done(layer, error, seconds):
+            if layer is not None:
+                self.record_cost(renderer, render_area, seconds)
+            self.handle_layer_done(key, layer, error)
+        priority = self.get_priority(render_area, self._job_serial.next())
+        self.workers.submit(priority, renderer, render_area, done, wanted)
+    
+    def handle_layer_done(self, key, layer, error):
+        waiting = self.pending_layers.pop(key, None)
+        if waiting is None:
+            return
+        if error is not None:
+            # Retry on the main loop, where any error surfaces as usual.
+            self.thread_failures.add(key[0])
+        elif layer is not None:
+            self.layer_cache[key] = layer
+        for fragment_info, renderer_index in waiting:
+            if fragment_info in self.cache:
+                self.add_job(fragment_info, renderer_index)
+        
+    def record_cost(self, renderer, render_area, seconds):
+        pixels = render_area.width * render_area.height
+        if not pixels:
+            return
+        cost = seconds / pixels
+        previous = self.render_costs.get(renderer.__class__)
+        if previous is not None:
+            cost = 0.8 * previous + 0.2 * cost
+        self.render_costs[renderer.__class__] = cost
+    
+    def draw_layer(self, cr, renderer, render_area, key):
+        """Paint what renderer draws in render_area, from the layer cache if possible.
+        
+        Each renderer's fragment layer is cached on its own, so that when one 
+        renderer changes only its layer needs to be redrawn.
+        """
+        layer = self.layer_cache.get(key)
+        if layer is None:
+            layer = cairo.ImageSurface(cairo.FORMAT_ARGB32, render_area.width, render_area.height)
+            layer_cr = pangocairo.CairoContext(cairo.Context(layer))
+            t = time.time()
+            renderer.render(layer_cr, render_area)
+            self.record_cost(renderer, render_area, time.time() - t)
+            self.layer_cache[key] = layer
+        cr.set_source_surface(layer, 0, 0)
+        cr.paint()
+            
+    def process_job(self):
+        try:
+            return self._process_job()
+        except:
+            # The idle source is gone, so let add_job schedule a new one.
+            self._idle_worker_id = None
+            raise
+    
+    def _process_job(self):
+        while self.jobs:
+            fragment_info, (renderer_index, serial) = self.jobs.pop()
+            # Worker threads may evict fragments at any time, through the 
+            # shared cache budget.
+            surface = self.cache.peek(fragment_info)
+            if surface is not None:
+                break
+        else:
             self._idle_worker_id = None
             return
-        self.pool.pop(job_index)
-        surface = self.cache.peek(fragment_info)
         cr = gtk.gdk.CairoContext(cairo.Context(surface))
+        if renderer_index is None:
+            self.clear_fragment(cr, fragment_info)
         self.draw_partial(cr, fragment_info, renderer_index)
         a = fragment_info.render_area
         self.emit('fragment-updated', a.x, a.y, a.width, a.height, a.total_width, a.total_height)
         return True
         
     def flush_jobs(self):
-        gobject.source_remove(self._idle_worker_id)
+        if self._idle_worker_id:
+            gobject.source_remove(self._idle_worker_id)
         self._idle_worker_id = None
-        self.pool = {}
+        self.jobs.clear()
+        self.pending_layers.clear()
 
 class ActionParamsDialog(gtk.Dialog):
     def __init__(self, action, window):
@@ -310,6 +636,25 @@ class ZoomView(gtk.DrawingArea):
                     'motion-notify-event': 'override',
                     'scroll-event': 'override'}
     fragment_size = 500
+    # Pick the fragment size for each zoom level so that rendering the slow
+    # layers of a fragment takes about fragment_seconds, going by measured 
+    # render costs. Levels with only fast layers get the largest fragments.
+    adaptive_fragment_size = True
+    fragment_seconds = 0.05
+    min_fragment_size = 200
+    max_fragment_size = 1000
+    # Keep at least this many screenfuls of fragments in the fragment cache, 
+    # whatever the fragment size, so that visible and prefetched fragments 
+    # are not evicted before their slow layers are drawn.
+    fragment_cache_screens = 3
+    # Pre-render fragments around the viewport while idle, spending at most
+    # this much memory on them.
+    prefetch = True
+    prefetch_bytes = 64 * 2**20
+    # Zoom levels to look for cached fragments in, to show scaled while the
+    # current level renders.
+    interim_levels = 4
+    
     def __init__(self, view=None):
         super(ZoomView, self).__init__()
         self.add_events(gtk.gdk.BUTTON_PRESS_MASK | 
@@ -328,7 +673,7 @@ class ZoomView(gtk.DrawingArea):
         if not isinstance(view, (PosView, SeqView)):
             self.set_property('can-focus', True)
         self.view = view
-        self.cache = Cache()
+        self.cache = Cache(budget=cache_budget)
         self._clickdrag = {2: None}
         self.partial_renderer = PartialDrawManager(self.cache)
         def draw_updates(partial_renderer, x, y, width, height, total_width, total_height):
@@ -346,6 +691,13 @@ class ZoomView(gtk.DrawingArea):
                 self.draw(gtk.gdk.Rectangle(x, y, width, height))
         self.partial_renderer.connect('fragment-updated', draw_updates)
         self._check_updates = None
+        self._scroll_origin = [None, None]
+        self._last_viewport = None
+        self._scroll_direction = (0, 0)
+        self._recent_levels = []
+        self._fragment_sizes = Cache(size=64)
+        self._pointer = None
+        self._prefetch_id = None
     
     def set_view(self, view):
         if self._view is not None:
@@ -364,8 +716,9 @@ class ZoomView(gtk.DrawingArea):
         if self._adjustments[axis] is not None:
             self._adjustments[axis].disconnect(self.connections['adjustments'][axis])
         self._adjustments[axis] = adj
+        self._scroll_origin[axis] = None
         if isinstance(adj, ZoomAdjustment):
-            self.connections['adjustments'][axis] = adj.connect('value-changed', lambda a: self.queue_draw())
+            self.connections['adjustments'][axis] = adj.connect('value-changed', self.handle_scroll, axis)
             page_size = self.get_allocation()[2 + axis]
             adj.set_page_size(page_size)
         else:
@@ -378,7 +731,37 @@ class ZoomView(gtk.DrawingArea):
                     self.queue_draw()
             self.connections['adjustments'][axis] = adj.connect('value-changed', handle_adj_value_change)
         
+    def handle_scroll(self, adj, axis):
+        """Shift the pixels already on screen, and redraw only what scrolls into view.
+        
+        Anything else, such as zooming or jumping more than a page, redraws 
+        the whole view.
+        """
+        last = self._scroll_origin[axis]
+        self._scroll_origin[axis] = (int(adj.value), adj.upper)
+        if (self.window is None or 
+            last is None or 
+            last[1] != adj.upper or 
+            abs(int(adj.value) - last[0]) >= adj.page_size):
+            self.queue_draw()
+            return
+        delta = int(adj.value) - last[0]
+        if not delta:
+            return
+        dx, dy = (-delta, 0) if axis == 0 else (0, -delta)
+        self.window.scroll(dx, dy)
+        # Overlays that stay put in the window have been shifted along with 
+        # everything else.
+        for overlay in self.view.overlays:
+            for area in overlay.get_fixed_areas():
+                self.queue_draw_area(*area)
+                self.queue_draw_area(area.x + dx, area.y + dy, area.width, area.height)
+    
     def handle_view_change(self, view, change):
+        if change.type == 'overlay_changed' and change.data.type == 'damage':
+            for area in change.data.data:
+                self.queue_draw_area(*area)
+            return
         if change.has_changed('hadjustment'):
                 self._connect_adjustment(view.hadjustment, 0)
         if change.has_changed('vadjustment'):
@@ -392,46 +775,240 @@ class ZoomView(gtk.DrawingArea):
         if isinstance(self.view.vadjustment, ZoomAdjustment):
             self.view.vadjustment.set_page_size(allocation.height)
     
-    def _get_fragment(self, render_area):
-        fragment_info = FragmentInfo(self.view.renderers, render_area)
+    def _get_fragment(self, render_area, preview=False):
+        """Return the fragment surface for render_area, drawing it if needed.
+        
+        With preview set, new fragments may show cached fragments of a recent 
+        zoom level, scaled, until they are drawn.
+        """
+        fragment_info = FragmentInfo(self.view.renderers, render_area, self.view.background)
         try:
             return self.cache[fragment_info]
         except:
             frag = cairo.ImageSurface(cairo.FORMAT_ARGB32, render_area.width, render_area.height)
-            self.cache[FragmentInfo(self.view.renderers, render_area)] = frag
+            self.cache[fragment_info] = frag
             cr = pangocairo.CairoContext(cairo.Context(frag))
-            if self.view.background:
-                cr.set_source_rgba(*self.view.background.rgba)
-                cr.paint()
+            if preview:
+                previous = self.get_interim_fragments(render_area)
+                self.partial_renderer.draw_preview(cr, fragment_info, previous)
+                return frag
+            self.partial_renderer.clear_fragment(cr, fragment_info)
             self.partial_renderer.draw_partial(cr, fragment_info)
             return frag 
     
+    def get_viewport(self):
+        """Return the RenderArea for everything currently scrolled into view."""
+        page = gtk.gdk.Rectangle(0, 0, int(self.view.hadjustment.page_size), int(self.view.vadjustment.page_size))
+        return RenderArea.from_view_area(self.view, page)
+    
+    def get_fragment_size(self, total_width, total_height):
+        """Return the fragment size for a zoom level. 
+        
+        It is picked when the level is first drawn and then kept, so that its 
+        cached fragments stay usable.
+        """
+        level = (total_width, total_height)
+        size = self._fragment_sizes.get(level)
+        if size is None:
+            size = self._fragment_sizes[level] = self.choose_fragment_size(total_width, total_height)
+        return size
+    
+    def choose_fragment_size(self, total_width, total_height):
+        if not self.adaptive_fragment_size:
+            return self.fragment_size
+        area = RenderArea(0, 0, self.fragment_size, self.fragment_size, total_width, total_height)
+        costs = self.partial_renderer.render_costs
+        cost = 0.0
+        for r in self.view.renderers.renderers:
+            if not r.get_slow_render(area):
+                continue
+            if r.__class__ not in costs:
+                return self.fragment_size
+            cost += costs[r.__class__]
+        if not cost:
+            return self.max_fragment_size
+        size = int(math.sqrt(self.fragment_seconds / cost))
+        size = max(self.min_fragment_size, min(size, self.max_fragment_size))
+        return size - size % 50
+    
+    def get_fragment_area(self, h, v, total_width, total_height):
+        """Return the RenderArea for fragment (h, v), or None if it is outside the image."""
+        size = self.get_fragment_size(total_width, total_height)
+        x = h * size
+        y = v * size
+        if h < 0 or v < 0 or x >= total_width or y >= total_height:
+            return None
+        fw = min(size, total_width - x)
+        fh = min(size, total_height - y)
+        return RenderArea(x, y, fw, fh, total_width, total_height)
+    
+    def get_fragment_span(self, render_area):
+        """Return the first and last fragment columns and rows covering render_area."""
+        size = self.get_fragment_size(render_area.total_width, render_area.total_height)
+        return (render_area.x / size,
+                (render_area.x + render_area.width) / size,
+                render_area.y / size,
+                (render_area.y + render_area.height) / size)
+    
     def draw_renderers(self, cr, area):
         render_area = RenderArea.from_view_area(self.view, area)
         if not (render_area.width and render_area.height):
             return 
+        viewport = self.get_viewport()
+        navigating = self._last_viewport is not None and viewport != self._last_viewport
+        self.partial_renderer.set_viewport(viewport)
+        self.update_scroll_direction(viewport)
+        self.update_cache_size(viewport)
         cr.translate(area.x, area.y)
         cr.rectangle(0, 0, render_area.width, render_area.height)
         cr.clip()
-        cr.translate(-(render_area.x % self.fragment_size), -(render_area.y % self.fragment_size))
-        h_first = render_area.x / self.fragment_size
-        v_first = render_area.y / self.fragment_size
-        h_last = (render_area.x + render_area.width) / self.fragment_size
-        v_last = (render_area.y + render_area.height) / self.fragment_size
-        # Drawing right to left, bottom up because the slow renderers stack 
-        # is, well, a stack. It processes last viewed fragment first. This will
-        # appear to the user as I'm actually drawing left to right, top down.
-        for v in range(v_last - v_first, -1, -1):
-            y = (v + v_first) * self.fragment_size
-            for h in range(h_last - h_first, -1, -1):
-                x = (h + h_first) * self.fragment_size
-                fw = min(self.fragment_size, render_area.total_width - x)
-                fh = min(self.fragment_size, render_area.total_height - y)
+        size = self.get_fragment_size(render_area.total_width, render_area.total_height)
+        cr.translate(-(render_area.x % size), -(render_area.y % size))
+        h_first, h_last, v_first, v_last = self.get_fragment_span(render_area)
+        # Slow render jobs are queued by distance from the viewport centre, so
+        # drawing order does not matter here.
+        for v in range(v_last - v_first + 1):
+            y = (v + v_first) * size
+            for h in range(h_last - h_first + 1):
+                x = (h + h_first) * size
+                fw = min(size, render_area.total_width - x)
+                fh = min(size, render_area.total_height - y)
                 a = RenderArea(x, y, fw, fh, render_area.total_width, render_area.total_height)
-                frag = self._get_fragment(a)
-                cr.set_source_surface(frag, h * self.fragment_size, v * self.fragment_size)
-                cr.rectangle(h * self.fragment_size, v * self.fragment_size, fw, fh)
+                frag = self._get_fragment(a, preview=navigating)
+                cr.set_source_surface(frag, h * size, v * size)
+                cr.rectangle(h * size, v * size, fw, fh)
                 cr.fill()
+        self.schedule_prefetch()
+    
+    def update_cache_size(self, viewport):
+        """Grow the fragment cache item limit to fit fragment_cache_screens viewports."""
+        size = self.get_fragment_size(viewport.total_width, viewport.total_height)
+        columns = int(math.ceil(float(viewport.width) / size)) + 1
+        rows = int(math.ceil(float(viewport.height) / size)) + 1
+        self.cache.size = max(self.cache.size, self.fragment_cache_screens * columns * rows)
+    
+    def get_interim_fragments(self, render_area, max_fragments=16):
+        """Return (surface, render_area) for cached fragments of a recent zoom level 
+        that together cover render_area, or an empty list if there are none.
+        """
+        renderers = self.view.renderers
+        for total_width, total_height in self._recent_levels:
+            if (total_width, total_height) == (render_area.total_width, render_area.total_height):
+                continue
+            xscale = float(total_width) / render_area.total_width
+            yscale = float(total_height) / render_area.total_height
+            old = RenderArea(render_area.x * xscale, 
+                             render_area.y * yscale, 
+                             math.ceil(render_area.width * xscale), 
+                             math.ceil(render_area.height * yscale), 
+                             total_width, 
+                             total_height)
+            h_first, h_last, v_first, v_last = self.get_fragment_span(old)
+            if (h_last - h_first + 1) * (v_last - v_first + 1) > max_fragments:
+                continue
+            found = []
+            for v in range(v_first, v_last + 1):
+                for h in range(h_first, h_last + 1):
+                    area = self.get_fragment_area(h, v, total_width, total_height)
+                    if area is None:
+                        continue
+                    surface = self.cache.peek(FragmentInfo(renderers, area))
+                    if surface is not None:
+                        found.append((surface, area))
+            if found:
+                return found
+        return []
+    
+    def update_scroll_direction(self, viewport):
+        last = self._last_viewport
+        self._last_viewport = viewport
+        if (last is None or 
+            last.total_width != viewport.total_width or 
+            last.total_height != viewport.total_height):
+            self._scroll_direction = (0, 0)
+            level = (viewport.total_width, viewport.total_height)
+            if level in self._recent_levels:
+                self._recent_levels.remove(level)
+            self._recent_levels.insert(0, level)
+            del self._recent_levels[self.interim_levels + 1:]
+            return
+        cmp_x = cmp(viewport.x, last.x)
+        cmp_y = cmp(viewport.y, last.y)
+        if cmp_x or cmp_y:
+            self._scroll_direction = (cmp_x, cmp_y)
+    
+    def get_zoomed_viewport(self, steps=1):
+        """Return the viewport after zooming steps around the pointer."""
+        extents = []
+        for axis, adj in enumerate(self._adjustments):
+            if not (isinstance(adj, ZoomAdjustment) and adj.base_size and adj.upper):
+                extents.append((adj.value, adj.upper))
+                continue
+            focus = 0.5 * adj.page_size
+            if self._pointer is not None:
+                focus = self._pointer[axis]
+            upper = int(adj.base_size * 1.1 ** (adj.magnitude + steps))
+            value = (adj.value + focus) * upper / adj.upper - focus
+            extents.append((max(0, min(value, upper - adj.page_size)), upper))
+        (x, total_width), (y, total_height) = extents
+        return RenderArea(x, y, 
+                          min(self._adjustments[0].page_size, total_width - x), 
+                          min(self._adjustments[1].page_size, total_height - y), 
+                          total_width, 
+                          total_height)
+    
+    def get_prefetch_areas(self, viewport):
+        """Return areas for the fragments to render ahead, most urgent first.
+        
+        That is the fragments just beyond the viewport in the direction of
+        recent scrolling, and then those for zooming in around the pointer.
+        """
+        areas = []
+        h_first, h_last, v_first, v_last = self.get_fragment_span(viewport)
+        dx, dy = self._scroll_direction
+        if dx:
+            h = h_last + 1 if dx > 0 else h_first - 1
+            areas.extend(self.get_fragment_area(h, v, viewport.total_width, viewport.total_height) for v in range(v_first, v_last + 1))
+        if dy:
+            v = v_last + 1 if dy > 0 else v_first - 1
+            areas.extend(self.get_fragment_area(h, v, viewport.total_width, viewport.total_height) for h in range(h_first, h_last + 1))
+        zoomed = self.get_zoomed_viewport()
+        if (zoomed.total_width, zoomed.total_height) != (viewport.total_width, viewport.total_height):
+            h_first, h_last, v_first, v_last = self.get_fragment_span(zoomed)
+            for v in range(v_first, v_last + 1):
+                areas.extend(self.get_fragment_area(h, v, zoomed.total_width, zoomed.total_height) for h in range(h_first, h_last + 1))
+        return [a for a in areas if a is not None and a.width > 0 and a.height > 0]
+    
+    def schedule_prefetch(self):
+        if not self.prefetch or self._prefetch_id is not None:
+            return
+        self._prefetch_id = gobject.idle_add(self._prefetch_fragments().next, priority=gobject.PRIORITY_LOW)
+        
+    def _prefetch_fragments(self):
+        """Render fragments around the viewport, one per idle callback.
+        
+        Runs below the priority of the slow render jobs for visible fragments, 
+        and leaves room for the visible fragments in the fragment cache.
+        """
+        viewport = self.partial_renderer.viewport
+        h_first, h_last, v_first, v_last = self.get_fragment_span(viewport)
+        room = self.cache.size - (h_last - h_first + 1) * (v_last - v_first + 1)
+        nbytes = 0
+        for area in self.get_prefetch_areas(viewport):
+            if room <= 0 or nbytes >= self.prefetch_bytes:
+                break
+            if self.partial_renderer.viewport != viewport:
+                # Start over from wherever the view is now.
+                self._prefetch_id = None
+                self.schedule_prefetch()
+                yield False
+            room -= 1
+            if FragmentInfo(self.view.renderers, area) in self.cache:
+                continue
+            nbytes += get_nbytes(self._get_fragment(area))
+            yield True
+        self._prefetch_id = None
+        yield False
 
     def draw_overlays(self, cr, area):
         for overlay in self.view.overlays:
@@ -456,14 +1033,23 @@ class ZoomView(gtk.DrawingArea):
             self.zoom_to_fit()
         if self._check_updates is None:
             self._check_updates = gobject.timeout_add(100, self.check_updates)
-        self.draw(event.area)
+        for area in event.region.get_rectangles():
+            self.draw(area)
         
     def check_updates(self):
+        """Redraw what animated overlays report, and stop when none are animated.
+        
+        Expose events start the polling again.
+        """
+        animated = False
         for overlay in self.view.overlays:
             areas = overlay.prepare_update() or []
             for area in areas:
                 self.queue_draw_area(*area)
-        return True
+            animated = animated or overlay.is_animated()
+        if not animated:
+            self._check_updates = None
+        return animated
                 
     def do_scroll_event(self, event):
         if event.state & gtk.gdk.SHIFT_MASK:
@@ -779,6 +1365,7 @@ class ZoomView(gtk.DrawingArea):
                 meta.regions.update_region(meta.region, start, length)
 
     def do_motion_notify_event(self, event):
+        self._pointer = (event.x, event.y)
         if not self.view.msa:
             return
         pos = None
@@ -9,7 +9,8 @@ import pangocairo
 
 from adjustments import ZoomAdjustment
 from color import Color
-from cache import Cache
+from cache import (Cache,
+                   cache_budget)
 from component import (Change, 
                        Connection, 
                        prop)
@@ -63,6 +64,18 @@ class Overlay(Renderer):
     def prepare_update(self):
         pass
     
+    def is_animated(self):
+        """Return True if the overlay needs prepare_update() to be polled."""
+        return False
+    
+    def damage(self, areas):
+        """Have the view redraw only areas, a list of view rectangles."""
+        self.emit('changed', Change('visualization', 'damage', areas))
+    
+    def get_fixed_areas(self):
+        """Return the view rectangles the overlay draws in that do not scroll with the view."""
+        return []
+    
     def integrate(self, ancestor, name=None):
         type = self.msaview_classname.split('.')[1]
         viewtype = 'view'
@@ -81,18 +94,43 @@ class Overlay(Renderer):
         self.msaview_name = view.add(self, name)
         return self.msaview_name
 
+def outline(rectangle):
+    """Return thin rectangles covering the edges of rectangle."""
+    x, y, width, height = rectangle
+    return [(x - 1, y - 1, width + 2, 3),
+            (x - 1, y + height - 2, width + 2, 3),
+            (x - 1, y - 1, 3, height + 2),
+            (x + width - 2, y - 1, 3, height + 2)]
+
+def outline_damage(old, new):
+    """Return rectangles covering what changes when the outlined, filled 
+    rectangles old are replaced by new.
+    """
+    region = gtk.gdk.Region()
+    for r in old:
+        region.union_with_rect(gtk.gdk.Rectangle(*r))
+    other = gtk.gdk.Region()
+    for r in new:
+        other.union_with_rect(gtk.gdk.Rectangle(*r))
+    region.xor(other)
+    for r in list(old) + list(new):
+        for edge in outline(r):
+            region.union_with_rect(gtk.gdk.Rectangle(*edge))
+    return region.get_rectangles()
+
 class Miniature(object):
     def __init__(self, renderer, width, height):
         self.renderer = renderer
+        self.renderer_key = renderer.get_cache_key()
         self.width = width
         self.height = height
     
     def __hash__(self):
-        return hash((self.__class__, self.renderer, self.width, self.height))
+        return hash((self.__class__, self.renderer_key, self.width, self.height))
     
     def __eq__(self, other):
         return (isinstance(other, self.__class__) and
-                other.renderer == self.renderer and
+                other.renderer_key == self.renderer_key and
                 other.width == self.width and
                 other.height == self.height) 
             
@@ -151,8 +189,12 @@ class Locator(Overlay):
     
     def __init__(self):
         Overlay.__init__(self)
-        self.cache = Cache()
+        self.cache = Cache(budget=cache_budget)
         self._last_navigate = None
+        # The miniature last drawn, shown until its replacement is built.
+        self._shown = None
+        self._building = None
+        self._build_id = None
         
     always_show = prop('always_show')
     timeout = prop('timeout')
@@ -202,25 +244,62 @@ class Locator(Overlay):
             return None
         return gtk.gdk.Rectangle(x, 0, width, height)
         
-    def _get_miniature(self, renderer_stack, width, height):
+    def _get_miniature(self, renderer_stack, width, height, wait=False):
+        """Return the miniature image, or the one last shown while it is built.
+        
+        The image may be None, or of another size than asked for, unless wait
+        is set.
+        """
         miniature = Miniature(renderer_stack, width, height)
         image = self.cache.get(miniature, None)
-        if image is None:
-            image = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(width), int(height))
-            cr = gtk.gdk.CairoContext(cairo.Context(image))
-            render_area = RenderArea(0, 0, width, height, width, height)
-            cr.set_source_rgb(1, 1, 1)
-            cr.paint()
-            for renderer in renderer_stack.renderers:
-                if renderer.get_slow_render(render_area):
-                    break
-                cr.save()
-                renderer.render(cr, render_area)
-                cr.restore()
+        if image is None and wait:
+            for more in self._build_miniature(miniature):
+                pass
+            image = self.cache.get(miniature, None)
+        if image is not None:
+            self._shown = image
+            return image
+        if miniature != self._building:
+            if self._build_id is not None:
+                gobject.source_remove(self._build_id)
+            self._building = miniature
+            build = self._build_miniature(miniature).next
+            self._build_id = gobject.idle_add(build, priority=gobject.PRIORITY_LOW)
+        return self._shown
+    
+    def _build_miniature(self, miniature):
+        """Draw the miniature one render step per idle callback.
+        
+        The steps draw the renderers' downsampled images where they have any,
+        and slow renderers are left out. 
+        """
+        width = miniature.width
+        height = miniature.height
+        image = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(width), int(height))
+        cr = gtk.gdk.CairoContext(cairo.Context(image))
+        render_area = RenderArea(0, 0, width, height, width, height)
+        cr.set_source_rgb(1, 1, 1)
+        cr.paint()
+        for i, renderer in miniature.renderer.get_render_steps(render_area):
+            if miniature.renderer.get_cache_key() != miniature.renderer_key:
+                # Outdated; the next draw starts over.
+                break
+            if renderer.get_slow_render(render_area):
+                break
+            cr.save()
+            renderer.render(cr, render_area)
+            cr.restore()
+            yield True
+        else:
             self.cache[miniature] = image
-        return image
+        if miniature == self._building:
+            self._building = None
+            self._build_id = None
+        if self.view is not None:
+            self.damage([self._get_area()])
+        yield False
         
-    def _draw(self, cr, area, view_area):
+    def _draw(self, cr, area, view_area, wait=False):
         locator_area = self._get_area(area, view_area)
         if locator_area is None:
             return
@@ -240,16 +319,22 @@ class Locator(Overlay):
         # Miniature
         width = locator_width - 2 * line_width
         height = locator_height - 2 * line_width
-        image = self._get_miniature(self.view.renderers, width, height)
+        image = self._get_miniature(self.view.renderers, width, height, wait)
         cr.save()
         cr.rectangle(line_width, line_width, width, height)
         cr.clip()
-        # A bug in cairo misaligns the paint_with_alpha origin vertically with vector backends. 
-        if vector_based(cr):
-            cr.set_source_surface(image, line_width, 1)
+        if image is None:
+            cr.set_source_rgba(1, 1, 1, self.alpha)
+            cr.paint()
         else:
-            cr.set_source_surface(image, line_width, line_width)
-        cr.paint_with_alpha(self.alpha)
+            cr.translate(line_width, line_width)
+            cr.scale(float(width) / image.get_width(), float(height) / image.get_height())
+            # A bug in cairo misaligns the paint_with_alpha origin vertically with vector backends. 
+            if vector_based(cr):
+                cr.set_source_surface(image, 0, 1 - line_width)
+            else:
+                cr.set_source_surface(image, 0, 0)
+            cr.paint_with_alpha(self.alpha)
         cr.restore()
         # View outline
         vx_first = int(float(view_area.x) / view_area.total_width * width)
@@ -270,7 +355,7 @@ class Locator(Overlay):
         if view_area is None:
             view_area = self.view._get_view_area()
         area = gtk.gdk.Rectangle(0, 0, view_area.width, view_area.height)
-        self._draw(cr, area, view_area)
+        self._draw(cr, area, view_area, wait=True)
         
     def prepare_update(self):
         if self.always_show or self._last_navigate is None:
@@ -279,6 +364,15 @@ class Locator(Overlay):
             self._last_navigate = None
             return [self._get_area()]
     
+    def is_animated(self):
+        return not self.always_show and self._last_navigate is not None
+    
+    def get_fixed_areas(self):
+        area = self._get_area()
+        if area is None:
+            return []
+        return [area]
+    
     def draw(self, cr, area):
         view_area = self.view._get_view_area()
         if not view_area:
@@ -362,6 +456,8 @@ class SelectionOverlay(Overlay):
     def __init__(self):
         Overlay.__init__(self)
         self._last_dash_update = time.time()
+        # The view area and rectangles last drawn, to find what changes.
+        self._drawn = None
         self.propvalues.update(
             area_dash=[3, 3],
             #area_fill=lines((0, 0, .3, 0.3), (0, 0, .3, 0.1), 2),
@@ -405,7 +501,37 @@ class SelectionOverlay(Overlay):
             self.handle_selection_change(self.selection, Change())
 
     def handle_selection_change(self, selection, changes):
-        self.emit('changed', Change('visualization'))
+        damage = self._get_damage()
+        if damage is None:
+            self.emit('changed', Change('visualization'))
+        else:
+            self.damage(damage)
+    
+    def _get_page_rectangles(self):
+        view_area = self.view and self.view._get_view_area()
+        if not self.selection or view_area is None:
+            return view_area, []
+        page = gtk.gdk.Rectangle(0, 0, int(view_area.width), int(view_area.height))
+        return view_area, sum(self._get_rectangles(page, view_area), [])
+    
+    def _get_damage(self):
+        """Return the view rectangles changed since the selection was last drawn, 
+        or None if that is not known.
+        """
+        view_area, rectangles = self._get_page_rectangles()
+        last = self._drawn
+        self._drawn = (view_area, rectangles)
+        if last is None or last[0] is None or view_area is None:
+            return None
+        last_area, last_rectangles = last
+        if (last_area.total_width != view_area.total_width or 
+            last_area.total_height != view_area.total_height):
+            return None
+        dx = last_area.x - view_area.x
+        dy = last_area.y - view_area.y
+        old = set((x + dx, y + dy, w, h) for x, y, w, h in last_rectangles)
+        new = set(tuple(r) for r in rectangles)
+        return outline_damage(old - new, new - old)
 
     def _msa_coordinates(self, value, page_size, upper, msa_size):
         first = int(float(value) / upper * msa_size)
@@ -540,9 +666,12 @@ class SelectionOverlay(Overlay):
         if t <= self._last_dash_update + self.update_interval:
             return
         self._last_dash_update = t
-        w = int(self.view.hadjustment.page_size)
-        h = int(self.view.vadjustment.page_size)
-        return sum(self._get_rectangles(gtk.gdk.Rectangle(0, 0, w, h), self.view._get_view_area()), [])
+        # Only the marching ants move.
+        self._drawn = self._get_page_rectangles()
+        return sum((outline(r) for r in self._drawn[1]), [])
+    
+    def is_animated(self):
+        return bool(self.selection)
     
     def get_options(self):
         return []
@@ -1,4 +1,7 @@
+import math
+
 import cairo
+import numpy
 
 from color import Color, Gradient
 
@@ -148,6 +151,8 @@ def tick_labels(cr, layout, color, alpha, tick_positions, item_size, area_x, are
 def bar(cr, color, alpha, values, first_pos, n_pos, x_offset, total_width, total_height):
     gradient = isinstance(color, Gradient)
     length = len(values)
+    if gradient:
+        colors = color.map_array(values[first_pos:first_pos + n_pos]) / 255.0
     for pos in range(first_pos, first_pos + n_pos):
         #x_start = int(round(float(pos) / length * total_width - x_offset))
         #x_stop = int(round(float(pos + 1) / length * total_width - x_offset))
@@ -157,8 +162,8 @@ def bar(cr, color, alpha, values, first_pos, n_pos, x_offset, total_width, total
         x_stop = float(pos + 1) / length * total_width - x_offset
         cr.rectangle(x_start, total_height - bar_height, x_stop - x_start, bar_height)
         if gradient:
-            c = color.get_color_from_offset(values[pos])
-            cr.set_source_rgba(*c.with_alpha(alpha).rgba)
+            b, g, r, a = colors[pos - first_pos]
+            cr.set_source_rgba(r, g, b, a * alpha)
             cr.fill()
     if color is None:
         return
@@ -169,6 +174,8 @@ def bar(cr, color, alpha, values, first_pos, n_pos, x_offset, total_width, total
 def v_bar(cr, color, alpha, values, first_seq, n_seq, y_offset, total_width, total_height):
     gradient = isinstance(color, Gradient)
     length = len(values)
+    if gradient:
+        colors = color.map_array(values[first_seq:first_seq + n_seq]) / 255.0
     for seq in range(first_seq, first_seq + n_seq):
         #y_start = int(round(float(seq) / length * total_height - y_offset))
         #y_stop = int(round(float(seq + 1) / length * total_height - y_offset))
@@ -178,8 +185,8 @@ def v_bar(cr, color, alpha, values, first_seq, n_seq, y_offset, total_width, tot
         bar_width = int(round(total_width * values[seq])) 
         cr.rectangle(0, y_start, bar_width, y_stop - y_start)
         if gradient:
-            c = color.get_color_from_offset(values[seq])
-            cr.set_source_rgba(*c.with_alpha(alpha).rgba)
+            b, g, r, a = colors[seq - first_seq]
+            cr.set_source_rgba(r, g, b, a * alpha)
             cr.fill()
     if color is None:
         return
@@ -239,17 +246,119 @@ def v_quartile_guidelines(cr, height, y_offset, total_width, total_height):
     cr.stroke()
     cr.restore()
     
-def scaled_image(cr, area, image, alpha):
-    width = image.get_width()
-    height = image.get_height()
+def halve_image_array(array, axis):
+    """Area-average neighboring pixel pairs along axis.
+    
+    Expects a (height, width, 4) uint8 array of premultiplied pixels, which 
+    average correctly channel by channel. An odd trailing pixel is averaged 
+    with itself, so the result covers half a pixel more than the input.
+    """
+    if array.shape[axis] == 1:
+        return array
+    a = array.astype(numpy.uint16)
+    if a.shape[axis] % 2:
+        last = a[:, -1:] if axis else a[-1:]
+        a = numpy.concatenate([a, last], axis)
+    if axis:
+        a = a[:, ::2] + a[:, 1::2] + 1
+    else:
+        a = a[::2] + a[1::2] + 1
+    return (a >> 1).astype(numpy.uint8)
+
+def image_from_array(array):
+    height, width = array.shape[:2]
+    image = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    image.flush()
+    a = numpy.frombuffer(image.get_data(), numpy.uint8)
+    a.shape = (height, width, -1)
+    a[:] = array
+    image.mark_dirty()
+    return image
+
+class ImagePyramid(object):
+    """Lazily built, area-averaged downsamplings of an image.
+    
+    Levels are (x, y) pairs giving the number of times the image has been 
+    halved horizontally and vertically. Axes are treated independently since 
+    alignments are seldom anywhere near square. Pixel i of level x covers 
+    pixels i * 2**x to (i + 1) * 2**x of the image, so the image spans 
+    width / 2.0**x pixels there, and odd sized levels end in a partly 
+    covered pixel.
+    """
+    def __init__(self, image):
+        self.image = image
+        self.width = image.get_width()
+        self.height = image.get_height()
+        array = numpy.frombuffer(image.get_data(), numpy.uint8)
+        array.shape = (self.height, self.width, -1)
+        self.levels = {(0, 0): (image, array)}
+        
+    def _get_level(self, x, y):
+        try:
+            return self.levels[(x, y)]
+        except KeyError:
+            pass
+        if x:
+            array = halve_image_array(self._get_level(x - 1, y)[1], 1)
+        else:
+            array = halve_image_array(self._get_level(x, y - 1)[1], 0)
+        level = (image_from_array(array), array)
+        self.levels[(x, y)] = level
+        return level
+    
+    def get_level(self, area):
+        """Return (x, y) for the most downsampled level still detailed enough for area."""
+        def level(total_size, size):
+            scale = float(total_size) / size
+            if scale >= 1:
+                return 0
+            max_level = int(math.ceil(math.log(size, 2)))
+            return min(int(math.floor(math.log(1 / scale, 2))), max_level)
+        return level(area.total_width, self.width), level(area.total_height, self.height)
+    
+    def get_image(self, area):
+        """Return the most downsampled image that is still detailed enough for area."""
+        return self._get_level(*self.get_level(area))[0]
+    
+    def render(self, cr, area, alpha):
+        """Draw the image scaled to area, from the level that suits it."""
+        x, y = self.get_level(area)
+        scaled_image(cr, area, self._get_level(x, y)[0], alpha, 
+                     self.width / 2.0 ** x, self.height / 2.0 ** y)
+
+def composite_images(layers):
+    """Paint (image, alpha) layers over each other, bottom first, into a new image."""
+    image = cairo.ImageSurface(cairo.FORMAT_ARGB32, layers[0][0].get_width(), layers[0][0].get_height())
+    cr = cairo.Context(image)
+    for layer, alpha in layers:
+        cr.set_source_surface(layer, 0, 0)
+        cr.paint_with_alpha(alpha)
+    image.flush()
+    return image
+
+def get_image_pyramid(pyramid, image):
+    """Return pyramid if it was built for image, otherwise a new one."""
+    if pyramid is not None and pyramid.image is image:
+        return pyramid
+    return ImagePyramid(image)
+
+def scaled_image(cr, area, image, alpha, width=None, height=None):
+    """Draw image scaled so that width by height image pixels fill the total area.
+    
+    width and height default to the image size.
+    """
+    if width is None:
+        width = image.get_width()
+    if height is None:
+        height = image.get_height()
     first_pos, x_offset = divmod(float(width * area.x) / area.total_width, 1)
     first_seq, y_offset = divmod(float(height * area.y) / area.total_height, 1)
     first_pos = int(first_pos)
     first_seq = int(first_seq)
     last_pos = int(width * float(area.x + area.width) / area.total_width)
     last_seq = int(height * float(area.y + area.height) / area.total_height)
-    n_pos = min(last_pos - first_pos + 1, width)
-    n_seq = min(last_seq - first_seq + 1, height)
+    n_pos = min(last_pos - first_pos + 1, image.get_width())
+    n_seq = min(last_seq - first_seq + 1, image.get_height())
     temp = cairo.ImageSurface(cairo.FORMAT_ARGB32, n_pos, n_seq)
     temp_cr = cairo.Context(temp)
     temp_cr.rectangle(0, 0, n_pos, n_seq)
@@ -266,23 +375,64 @@ def scaled_image(cr, area, image, alpha):
     cr.set_source(pattern)
     cr.rectangle(0, 0, n_pos, n_seq)
     cr.fill()
+
+def get_color_runs(array, merge_rows=True):
+    """Find rectangles of identically colored pixels in an image array.
+    
+    Horizontally adjacent pixels of the same color are merged into runs, 
+    and if merge_rows is True, identical runs in consecutive rows are merged
+    too. Fully transparent pixels are skipped. Returns a dict of pixel value
+    (the four bytes packed into a uint32) to lists of (x, y, width, height) 
+    rectangles.
+    """
+    height, width = array.shape[:2]
+    if not (height and width):
+        return {}
+    pixels = numpy.ascontiguousarray(array).view(numpy.uint32).reshape(height, width)
+    opaque = numpy.ascontiguousarray(array[..., 3]) != 0
+    runs = {}
+    open_runs = {}
+    for y in range(height):
+        row = pixels[y]
+        bounds = numpy.nonzero(row[1:] != row[:-1])[0] + 1
+        starts = numpy.concatenate(([0], bounds))
+        stops = numpy.concatenate((bounds, [width]))
+        keep = opaque[y, starts]
+        starts = starts[keep]
+        stops = stops[keep]
+        row_runs = {}
+        for x, stop, value in zip(starts.tolist(), stops.tolist(), row[starts].tolist()):
+            key = (x, stop, value)
+            rect = open_runs.get(key) if merge_rows else None
+            if rect is None:
+                rect = [x, y, stop - x, 1]
+                runs.setdefault(value, []).append(rect)
+            else:
+                rect[3] += 1
+            row_runs[key] = rect
+        open_runs = row_runs
+    return runs
+
+def scaled_image_rectangles(cr, area, array, alpha, merge_rows=True):
+    """Draw an image array as one filled rectangle per run of same colored cells.
     
-def scaled_image_rectangles(cr, area, array, alpha):
+    Intended for vector backends, where one rectangle per cell makes for 
+    enormous output. All rectangles of the same color are filled at once.
+    """
     height, width = array.shape[:2]
     (first_pos, n_pos, xscale), (first_seq, n_seq, yscale) = area.item_extents(width, height)
     cr.rectangle(0, 0, area.width, area.height)
     cr.clip()
     cr.translate(-area.x, -area.y)
-    for seq in range(first_seq, first_seq + n_seq):
-        for pos in range(first_pos, first_pos + n_pos):
-            b, g, r, a = array[seq,pos]/255.0
-            cr.set_source_rgba(r, g, b, a * alpha)
-            x = pos * xscale
-            y = seq*yscale
-            xstop = (pos + 1) * xscale
-            ystop = (seq + 1) * yscale
-            cr.rectangle(x, y, xscale, yscale)
-            cr.fill()
+    block = array[first_seq:first_seq + n_seq, first_pos:first_pos + n_pos]
+    bgra = numpy.zeros(1, numpy.uint32)
+    for value, rectangles in get_color_runs(block, merge_rows).items():
+        bgra[0] = value
+        b, g, r, a = bgra.view(numpy.uint8) / 255.0
+        for x, y, w, h in rectangles:
+            cr.rectangle((first_pos + x) * xscale, (first_seq + y) * yscale, w * xscale, h * yscale)
+        cr.set_source_rgba(r, g, b, a * alpha)
+        cr.fill()
 
 def outlined_regions(cr, area, n_positions, n_sequences, features, linewidth, color, alpha, merged=False):
     first_pos, n_pos, x_scale = area.item_extents_for_axis(n_positions, 'width')
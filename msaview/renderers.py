@@ -1,8 +1,16 @@
+import atexit
+import bisect
+import contextlib
+import cPickle
+import heapq
 import itertools
 import math
+import os
 import re
 import string
 import sys
+import threading
+import time
 
 import cairo 
 import gobject
@@ -19,15 +27,20 @@ from color import (Color,
                    GradientSetting,
                    RegexColormap,
                    RegexColormapSetting)
-from cache import Cache
+from cache import (Cache,
+                   cache_budget,
+                   get_nbytes)
 from component import (Change, 
                        Component, 
                        prop)
+from computation import BackgroundTask
+from features import IntervalIndex
 import log
 from preset import (BoolSetting,
                     ComponentSetting,
                     FloatSetting,
                     FontSetting,
+                    IntSetting,
                     RegexSetting,
                     Setting,
                     SettingList,
@@ -43,16 +56,21 @@ from options import (BooleanOption,
                      FontOption,
                      GradientOption,
                      GradientPreview,
+                     IntOption,
                      Option,
                      RegexColormapOption,
                      RegexOption,
                      ResidueColormapOption,
                      SimpleOptionConfigDialog,
                      _UNSET)
-from plotting import (chequers, 
+from plotting import (bar,
+                      chequers, 
+                      composite_images,
+                      get_image_pyramid,
                       get_view_extents, 
                       outlined_regions,
-                      scaled_image, 
+                      quartile_guidelines,
+                      scaled_image,
                       scaled_image_rectangles, 
                       v_bar,
                       vector_based)
@@ -63,7 +81,7 @@ try:
     import _renderers
 except:
     _renderers = None
-    
+
 # NOT TODO:
 # * Renderers should keep the __hash__ silliness in order to work well with the cache. think for example alpha change and caching.
   
@@ -139,6 +157,70 @@ class RenderArea(object):
         n_seq = int(math.ceil(float(self.y + self.height) / self.total_height * len(msa.sequences))) - first_seq
         return Area(Region(first_pos, n_pos), Region(first_seq, n_seq))
         
+class RenderLock(object):
+    """Lets worker threads render together, but not while state changes.
+    
+    Workers hold reading() around render(), and the main loop holds writing()
+    while it changes state that render() reads. Writers wait for ongoing 
+    renders to finish, and new renders wait for waiting writers. writing() 
+    may be nested within one thread.
+    """
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writers = 0
+        self._writer = None
+        self._depth = 0
+    
+    @contextlib.contextmanager
+    def reading(self):
+        with self._condition:
+            while self._writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+    
+    @contextlib.contextmanager
+    def writing(self):
+        thread = threading.current_thread()
+        with self._condition:
+            if self._writer is not thread:
+                self._writers += 1
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+                self._writer = thread
+            self._depth += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._depth -= 1
+                if not self._depth:
+                    self._writer = None
+                    self._writers -= 1
+                    self._condition.notify_all()
+
+_thread_pango = threading.local()
+
+def get_thread_pango_context():
+    """Return a pango context for use in the calling thread only.
+    
+    Each thread gets a font map of its own too, since the default font map 
+    is not thread safe in older pango versions.
+    """
+    try:
+        return _thread_pango.context
+    except AttributeError:
+        _thread_pango.font_map = pangocairo.CairoFontMap()
+        _thread_pango.context = _thread_pango.font_map.create_context()
+        return _thread_pango.context
+
 class Renderer(Component):
     __gproperties__ = dict(
         alpha = (
@@ -152,6 +234,12 @@ class Renderer(Component):
 
     alpha = prop('alpha')
     
+    # Set in subclasses whose render() may run in a worker thread, on a 
+    # private surface, while the main loop goes on. Such renderers must have
+    # a RenderLock as render_lock, held for writing while their state changes,
+    # and only use get_thread_pango_context() for text while rendering.
+    thread_safe = False
+    
     def __eq__(self, other):
         if other is self:
             return True
@@ -179,6 +267,14 @@ class Renderer(Component):
     def get_slow_render(self, area):
         return False
 
+    def get_scaled_image(self, area):
+        """Return (image, alpha) if rendering area would only paint image scaled to it.
+        
+        Renderer stacks may then composite such images from several renderers
+        and draw them in one go. Return None otherwise.
+        """
+        return None
+
     def get_options(self):
         return [FloatOption(self, 'alpha', hint_digits=2)]
 
@@ -331,7 +427,177 @@ class MSARenderer(Renderer):
         self.handle_msa_change(msa, Change())
         return self.msaview_name 
 
-class ScaledImage(MSARenderer):
+class RowColorizer(threading.Thread):
+    """Paint an image array in bands of rows from a worker thread.
+
+    colorize_rows(array, start, stop) should paint rows start:stop of array,
+    using only data that the main loop will not change meanwhile.
+    """
+    band_size = 256
+
+    def __init__(self, array, colorize_rows, band_size=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.array = array
+        self.colorize_rows = colorize_rows
+        if band_size is None:
+            band_size = self.__class__.band_size
+        self.band_size = band_size
+        self.rows_done = 0
+        self.error = None
+        self._abort = False
+
+    def run(self):
+        height = len(self.array)
+        try:
+            for start in range(0, height, self.band_size):
+                if self._abort:
+                    break
+                stop = min(start + self.band_size, height)
+                self.colorize_rows(self.array, start, stop)
+                self.rows_done = stop
+        except Exception, e:
+            self.error = e
+
+    def abort(self):
+        self._abort = True
+
+class ColorizeTask(BackgroundTask):
+    """Colorize an image in the background, reporting progress as rows finish."""
+    can_block = True
+    
+    def __init__(self, image, colorize_rows):
+        BackgroundTask.__init__(self)
+        self.image = image
+        image.flush()
+        array = numpy.frombuffer(image.get_data(), numpy.uint8)
+        array.shape = (image.get_height(), image.get_width(), -1)
+        self.colorizer = RowColorizer(array, colorize_rows)
+        self.rows_published = 0
+
+    def process(self, block=False):
+        if self._abort:
+            return False
+        colorizer = self.colorizer
+        if colorizer.ident is None and block:
+            colorizer.run()
+        elif colorizer.ident is None:
+            colorizer.start()
+        elif block:
+            colorizer.join()
+        if colorizer.error:
+            self._abort = True
+            self.emit('error', 'error', colorizer.error)
+            return False
+        rows_done = colorizer.rows_done
+        finished = not colorizer.is_alive()
+        if rows_done > self.rows_published or finished:
+            self.rows_published = rows_done
+            self.image.mark_dirty()
+            height = self.image.get_height()
+            self.emit('progress', float(rows_done) / max(height, 1), finished, rows_done)
+        return not finished
+
+    def get_partial_image(self):
+        """Return an image of the rows published so far, or None if there are none.
+        
+        It shares memory with the image, but only covers rows that the worker
+        will not touch again.
+        """
+        rows = self.rows_published
+        if not rows:
+            return None
+        array = self.colorizer.array[:rows]
+        return cairo.ImageSurface.create_for_data(array, cairo.FORMAT_ARGB32, self.image.get_width(), rows, self.image.get_stride())
+
+    def abort(self):
+        self._abort = True
+        self.colorizer.abort()
+
+class BackgroundColorizing(object):
+    """Mixin for renderers that fill their images in row bands from a worker thread.
+
+    New images are built off screen and published through 
+    set_colorized_image() only when they are done. Until then the previous 
+    image stays on show, if it has the same size. Otherwise the rows done so 
+    far are published as partial_image every partial_image_interval seconds,
+    each time with a change emission, so that no cache keeps a stale one.
+    """
+    background_colorizing = True
+    colorize_poll_interval = 50
+    partial_image_interval = 0.5
+    partial_image = None
+    _colorize_task = None
+    _colorize_job = None
+    _partial_image_time = None
+
+    def start_colorizing(self, image, colorize_rows, current=None):
+        """Start filling image, and return the image to show meanwhile.
+        
+        That is image itself if it got done right away, otherwise current if
+        it is the same size, or None.
+        """
+        self.abort_colorizing()
+        task = ColorizeTask(image, colorize_rows)
+        if not self.background_colorizing:
+            task.process(block=True)
+            return image
+        task.connect('progress', self._handle_colorize_progress)
+        task.connect('error', self._handle_colorize_error)
+        self._colorize_task = task
+        self._colorize_job = self.get_compute_manager().timeout_add(self.colorize_poll_interval, task)
+        if (current is not None and 
+            current.get_width() == image.get_width() and 
+            current.get_height() == image.get_height()):
+            return current
+        self._partial_image_time = 0
+        return None
+
+    def abort_colorizing(self):
+        if self._colorize_task is None:
+            return
+        self._colorize_task.abort()
+        self.get_compute_manager().source_remove(self._colorize_job)
+        self._colorize_task = None
+        self._colorize_job = None
+        self._partial_image_time = None
+        self.partial_image = None
+
+    def set_colorized_image(self, image):
+        """Publish a finished image."""
+        self.image = image
+
+    def set_partial_image(self, image):
+        """Publish the rows done so far of an image without a previous one to show."""
+        self.partial_image = image
+        self.emit('changed', Change('visualization'))
+
+    def _handle_colorize_progress(self, task, fraction, finished, rows):
+        if task is not self._colorize_task:
+            return
+        if not finished:
+            now = time.time()
+            if (self._partial_image_time is not None and 
+                now - self._partial_image_time >= self.partial_image_interval):
+                self._partial_image_time = now
+                self.set_partial_image(task.get_partial_image())
+            return
+        self._colorize_task = None
+        self._colorize_job = None
+        self._partial_image_time = None
+        self.partial_image = None
+        self.set_colorized_image(task.image)
+
+    def _handle_colorize_error(self, task, type, error):
+        if task is not self._colorize_task:
+            return
+        self._colorize_task = None
+        self._colorize_job = None
+        self._partial_image_time = None
+        self.partial_image = None
+        log.get_logger(self.msaview_classname).error('colorizing failed: %s', error)
+
+class ScaledImage(MSARenderer, BackgroundColorizing):
     __gproperties__ = dict(
         array = (gobject.TYPE_PYOBJECT,
             'image array',
@@ -345,6 +611,10 @@ class ScaledImage(MSARenderer):
     array = prop('array')
     image = prop('image')
     
+    def __init__(self):
+        MSARenderer.__init__(self)
+        self._pyramid = None
+
     def __eq__(self, other):
         if other is self:
             return True
@@ -369,19 +639,47 @@ class ScaledImage(MSARenderer):
         
     def colorize(self, msa):
         if not msa:
+            self.abort_colorizing()
             return None
-        width = len(msa) 
+        width = len(msa)
         height = len(msa.sequences)
         image = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-        return image
-    
+        colorize_rows = self.get_row_colorizer(msa)
+        if colorize_rows is None:
+            self.abort_colorizing()
+            return image
+        return self.start_colorizing(image, colorize_rows, self.image)
+
+    def get_row_colorizer(self, msa):
+        """Return a function(array, start, stop) that paints rows of the msa image.
+
+        It is called from a worker thread, so it should only use data that
+        is captured when it is created. Return None for a blank image.
+        """
+        return None
+
     def render(self, cr, area):
         if not self.image:
+            if self.partial_image is not None and not vector_based(cr):
+                self.render_partial_image(cr, area)
             return
         if vector_based(cr):
             scaled_image_rectangles(cr, area, self.array, self.alpha)
-        else:
-            scaled_image(cr, area, self.image, self.alpha)
+            return
+        self._pyramid = get_image_pyramid(self._pyramid, self.image)
+        self._pyramid.render(cr, area, self.alpha)
+
+    def render_partial_image(self, cr, area):
+        """Draw the rows colorized so far, where the whole image will go."""
+        height = len(self.msa.sequences)
+        if float(height * area.y) / area.total_height >= self.partial_image.get_height():
+            return
+        scaled_image(cr, area, self.partial_image, self.alpha, self.partial_image.get_width(), height)
+
+    def get_scaled_image(self, area):
+        if not self.image:
+            return None
+        return self.image, self.alpha
     
     def get_detail_size(self):
         if not self.image:
@@ -431,32 +729,26 @@ class ResidueColors(ScaledImage):
             return
         ScaledImage.do_set_property(self, pspec, value) 
     
-    @log.trace
-    def colorize(self, msa):
-        if not msa:
-            return None
-        image = ScaledImage.colorize(self, msa)
-        image.flush()
-        array = numpy.frombuffer(image.get_data(), numpy.uint8)
-        array.shape = (len(msa.sequences), len(msa), -1)
+    def get_row_colorizer(self, msa):
         colormap = self.colormap or presets.get_value('colormap:clustalx')
         unrecognized = self.unrecognized or Color(0, 0, 0, 0)
         try:
             colormap = colormap.flatten()
         except AttributeError:
             pass
-        if not _renderers:
-            for y, sequence in enumerate(msa.sequences):
-                for x, letter in enumerate(sequence):
-                    array[y, x] = colormap.get(letter, unrecognized).array
-            image.mark_dirty()
-            return image
-        _renderers.residue_colors_colorize(array, 
-                                           msa.sequence_array, 
-                                           colormap,
-                                           unrecognized.array)
-        image.mark_dirty()
-        return image
+        sequences = list(msa.sequences)
+        sequence_array = msa.sequence_array
+        def colorize_rows(array, start, stop):
+            if not _renderers:
+                for y in range(start, stop):
+                    for x, letter in enumerate(sequences[y]):
+                        array[y, x] = colormap.get(letter, unrecognized).array
+                return
+            _renderers.residue_colors_colorize(array[start:stop],
+                                               sequence_array[start:stop],
+                                               colormap,
+                                               unrecognized.array)
+        return colorize_rows
     
     def get_options(self):
         options = [ResidueColormapOption(self), 
@@ -513,37 +805,38 @@ class RegexColors(ScaledImage):
             return
         ScaledImage.do_set_property(self, pspec, value) 
 
-    def colorize(self, msa):
-        if not msa:
+    def get_row_colorizer(self, msa):
+        if not self.colormap:
             return None
-        image = ScaledImage.colorize(self, msa)
-        image.flush()
-        array = numpy.frombuffer(image.get_data(), numpy.uint8)
-        array.shape = (len(msa.sequences), len(msa), -1)
-        array[:] = 0
         try:
             colormap = self.colormap.flatten()
         except AttributeError:
             colormap = self.colormap
-        for regex, color in colormap.mappings:
-            r = re.compile(regex)
-            for v, sequence in enumerate(msa.sequences):
-                for m in r.finditer(sequence):
-                    paint_all = True
-                    for group_name in m.groupdict():
-                        if group_name.lower().startswith('paint'):
-                            array[v, m.start(group_name):m.end(group_name)] = color.array
-                            paint_all = False
-                    if paint_all:
-                        array[v, m.start(0):m.end(0)] = color.array
-        image.mark_dirty()
-        return image
+        mappings = [(re.compile(regex), color.array) for regex, color in colormap.mappings]
+        sequences = list(msa.sequences)
+        def colorize_rows(array, start, stop):
+            for r, color in mappings:
+                for v in range(start, stop):
+                    for m in r.finditer(sequences[v]):
+                        paint_all = True
+                        for group_name in m.groupdict():
+                            if group_name.lower().startswith('paint'):
+                                array[v, m.start(group_name):m.end(group_name)] = color
+                                paint_all = False
+                        if paint_all:
+                            array[v, m.start(0):m.end(0)] = color
+        return colorize_rows
         
     def render(self, cr, area):
         if not self.colormap:
             return
         ScaledImage.render(self, cr, area) 
 
+    def get_scaled_image(self, area):
+        if not self.colormap:
+            return None
+        return ScaledImage.get_scaled_image(self, area)
+
     def get_options(self):
         return ScaledImage.get_options(self) + [RegexColormapOption(self)]
 
@@ -738,26 +1031,33 @@ class ResidueScaleColors(ScaledImage):
     def colorize(self, msa):
         if not (msa and self.scale and self.gradient):
             return None
-        image = ScaledImage.colorize(self, msa)
-        image.flush()
-        array = numpy.frombuffer(image.get_data(), numpy.uint8)
-        array.shape = (len(msa.sequences), len(msa), -1)
-        array[:] = 0
-        values = self.scale.mappings.values()
+        return ScaledImage.colorize(self, msa)
+
+    def get_row_colorizer(self, msa):
+        aas, values = zip(*self.scale.mappings.items())
         offset = min(values)
         scale = max(values) - offset 
-        colormap = dict((aa.lower(), self.gradient.get_color_from_offset((v - offset)/scale)) for aa, v in self.scale.mappings.items())
-        for y, sequence in enumerate(msa.sequences):
-            for x, letter in enumerate(sequence):
-                array[y, x] = colormap.get(letter.lower(), self.unrecognized).array
-        image.mark_dirty()
-        return image
+        colors = self.gradient.map_array([(v - offset)/scale for v in values])
+        lut = numpy.empty((256, 4), numpy.uint8)
+        lut[:] = self.unrecognized.array
+        lut[ord(' ')] = 0
+        for aa, color in zip(aas, colors):
+            lut[[ord(aa.lower()), ord(aa.upper())]] = color
+        sequence_array = msa.sequence_array
+        def colorize_rows(array, start, stop):
+            array[start:stop] = lut.take(sequence_array[start:stop], axis=0)
+        return colorize_rows
         
     def render(self, cr, area):
         if not (self.msa and self.scale and self.gradient):
             return
         ScaledImage.render(self, cr, area) 
 
+    def get_scaled_image(self, area):
+        if not (self.msa and self.scale and self.gradient):
+            return None
+        return ScaledImage.get_scaled_image(self, area)
+
     def get_options(self):
         return ScaledImage.get_options(self) + [GradientOption(self), ResidueScaleOption(self), ColorOption(self, 'unrecognized')]
 
@@ -770,6 +1070,306 @@ class ResidueScaleColorsSetting(ComponentSetting):
     
 presets.register_component_defaults(ResidueScaleColorsSetting)
 
+class IdentityColors(ScaledImage):
+    __gproperties__ = dict(
+        reference = (
+            gobject.TYPE_INT,
+            'reference',
+            'index of the sequence to compare to, or -1 for the consensus',
+            -1,
+            sys.maxint,
+            -1,
+            gobject.PARAM_READWRITE),
+        similarity = (
+            gobject.TYPE_BOOLEAN,
+            'similarity',
+            'also mark residues that score positive in blosum62',
+            True,
+            gobject.PARAM_READWRITE),
+        identical = (
+            gobject.TYPE_PYOBJECT,
+            'identical',
+            'the color for residues identical to the reference',
+            gobject.PARAM_READWRITE),
+        similar = (
+            gobject.TYPE_PYOBJECT,
+            'similar',
+            'the color for residues similar to the reference',
+            gobject.PARAM_READWRITE),
+        different = (
+            gobject.TYPE_PYOBJECT,
+            'different',
+            'the color for residues that differ from the reference',
+            gobject.PARAM_READWRITE))
+
+    msaview_classname = 'renderer.msa.identity'
+
+    propdefaults = dict(alpha=1.0,
+                        reference=-1,
+                        similarity=True,
+                        identical=presets.get_value('color:clustalx_blue'),
+                        similar=presets.get_value('color:lightblue'),
+                        different=presets.get_value('color:transparent'))
+
+    reference = prop('reference')
+    similarity = prop('similarity')
+    identical = prop('identical')
+    similar = prop('similar')
+    different = prop('different')
+
+    GAP, DIFFERENT, SIMILAR, IDENTICAL = range(4)
+    _pair_classes = {}
+
+    def __init__(self):
+        ScaledImage.__init__(self)
+        self._consensus = None
+
+    def __hash__(self):
+        return hash((IdentityColors, self.msa, self.reference, self.similarity, self.identical, self.similar, self.different, self.alpha))
+
+    def __eq__(self, other):
+        if other is self:
+            return True
+        return (isinstance(other, self.__class__) and
+                other.msa == self.msa and
+                other.reference == self.reference and
+                other.similarity == self.similarity and
+                other.identical == self.identical and
+                other.similar == self.similar and
+                other.different == self.different and
+                other.alpha == self.alpha)
+
+    def do_set_property(self, pspec, value):
+        name = pspec.name.replace('-', '_')
+        if name in ['reference', 'similarity', 'identical', 'similar', 'different']:
+            if value != getattr(self, name):
+                self.propvalues[name] = value
+                self.image = self.colorize(self.msa)
+            return
+        ScaledImage.do_set_property(self, pspec, value)
+
+    def get_residue_lut(self, msa):
+        """Return a lut that maps residues to upper case and gaps to 0."""
+        lut = numpy.arange(256).astype(numpy.uint8)
+        lut[ord('a'):ord('z') + 1] -= ord('a') - ord('A')
+        lut[[ord(c) for c in msa.gapchars + ' ']] = 0
+        return lut
+
+    def get_pair_classes(self, similarity):
+        """Return a 256 x 256 lut of the class of each pair of normalized residues."""
+        classes = self._pair_classes.get(similarity)
+        if classes is not None:
+            return classes
+        classes = numpy.empty((256, 256), numpy.uint8)
+        classes[:] = self.DIFFERENT
+        if similarity:
+            try:
+                from msaview_plugin_substitution_matrix import get_matrix
+            except ImportError:
+                # Without the plugin, similar residues count as different.
+                get_matrix = None
+            if get_matrix:
+                matrix = get_matrix('blosum62')
+                aas = matrix.get_alphabet()
+                for a in aas:
+                    for b in aas:
+                        if matrix.lookup(a, b) > 0:
+                            classes[ord(a), ord(b)] = self.SIMILAR
+        classes[numpy.arange(256), numpy.arange(256)] = self.IDENTICAL
+        classes[0, :] = classes[:, 0] = self.GAP
+        self._pair_classes[similarity] = classes
+        return classes
+
+    def get_consensus(self, sequence_array, residues, block_size=2**20):
+        """Return the most common residue in each column, or 0 for all-gap columns.
+        
+        Residues are counted with one bincount per block of columns, over 
+        about block_size cells at a time.
+        """
+        cached = self._consensus
+        if cached is not None and cached[0] is sequence_array:
+            return cached[1]
+        n_sequences, n_columns = sequence_array.shape
+        consensus = numpy.zeros(n_columns, numpy.uint8)
+        step = max(1, block_size / max(n_sequences, 1))
+        for start in range(0, n_columns, step):
+            letters = residues.take(sequence_array[:, start:start + step]).astype(numpy.intp)
+            width = letters.shape[1]
+            letters += numpy.arange(width) * 256
+            counts = numpy.bincount(letters.ravel(), minlength=width * 256).reshape(width, 256)
+            counts[:, 0] = 0
+            consensus[start:start + width] = counts.argmax(axis=1)
+        self._consensus = (sequence_array, consensus)
+        return consensus
+
+    def get_row_colorizer(self, msa):
+        residues = self.get_residue_lut(msa)
+        classes = self.get_pair_classes(self.similarity)
+        colors = numpy.zeros((4, 4), numpy.uint8)
+        colors[self.DIFFERENT] = self.different.array
+        colors[self.SIMILAR] = self.similar.array
+        colors[self.IDENTICAL] = self.identical.array
+        sequence_array = msa.sequence_array
+        reference = [None]
+        if 0 <= self.reference < len(msa.sequences):
+            reference[0] = residues.take(sequence_array[self.reference])
+        def colorize_rows(array, start, stop):
+            if reference[0] is None:
+                # Counting takes a while on large alignments, so leave it to 
+                # the worker thread.
+                reference[0] = self.get_consensus(sequence_array, residues)
+            pairs = classes[residues.take(sequence_array[start:stop]), reference[0]]
+            array[start:stop] = colors.take(pairs, axis=0)
+        return colorize_rows
+
+    def get_options(self):
+        n_sequences = len(self.msa.sequences) if self.msa else 0
+        options = [IntOption(self, 'reference', hint_maximum=max(n_sequences - 1, 0)),
+                   BooleanOption(self, 'similarity'),
+                   ColorOption(self, 'identical'),
+                   ColorOption(self, 'similar'),
+                   ColorOption(self, 'different')]
+        return ScaledImage.get_options(self) + options
+
+class IdentityColorsSetting(ComponentSetting):
+    component_class = IdentityColors
+    setting_types = dict(alpha=FloatSetting,
+                         reference=IntSetting,
+                         similarity=BoolSetting,
+                         identical=ColorSetting,
+                         similar=ColorSetting,
+                         different=ColorSetting)
+
+presets.register_component_defaults(IdentityColorsSetting)
+
+class ResidueScaleProfile(MSARenderer):
+    __gproperties__ = dict(
+        gradient = (
+            gobject.TYPE_PYOBJECT,
+            'gradient',
+            'the colors for different bar heights in the plot',
+            gobject.PARAM_READWRITE),
+        scale = (
+            gobject.TYPE_PYOBJECT,
+            'scale',
+            'the residue scale to use',
+            gobject.PARAM_READWRITE),
+        window = (
+            gobject.TYPE_INT,
+            'window',
+            'number of positions to average over',
+            1,
+            10000,
+            9,
+            gobject.PARAM_READWRITE))
+
+    msaview_classname = 'renderer.pos.scale'
+
+    propdefaults = dict(alpha=1.0,
+                        gradient=presets.get_value('gradient:ryg'),
+                        scale=ResidueScale(),
+                        window=9)
+
+    gradient = prop('gradient')
+    scale = prop('scale')
+    window = prop('window')
+
+    def __init__(self):
+        MSARenderer.__init__(self)
+        self.profiles = Cache(size=10)
+
+    def __hash__(self):
+        return hash((ResidueScaleProfile, self.msa, self.gradient, self.scale, self.window, self.alpha))
+
+    def __eq__(self, other):
+        if other is self:
+            return True
+        return (isinstance(other, self.__class__) and
+                other.msa == self.msa and
+                other.gradient == self.gradient and
+                other.scale == self.scale and
+                other.window == self.window and
+                other.alpha == self.alpha)
+
+    def do_set_property(self, pspec, value):
+        name = pspec.name.replace('-', '_')
+        if name in ['gradient', 'scale', 'window']:
+            if value != getattr(self, name):
+                self.propvalues[name] = value
+                self.emit('changed', Change('visualization'))
+            return
+        MSARenderer.do_set_property(self, pspec, value)
+
+    def handle_msa_change(self, msa, change):
+        if not change.has_changed('sequences'):
+            return
+        self.profiles.flush()
+        self.emit('changed', Change('visualization'))
+
+    def get_profile(self):
+        """Return windowed scale averages over residues (not gaps), scaled to 0-1."""
+        if not (self.msa and self.scale):
+            return None
+        key = (self.scale, self.window)
+        profile = self.profiles.get(key)
+        if profile is not None:
+            return profile
+        aas, values = zip(*self.scale.mappings.items())
+        offset = min(values)
+        scale = (max(values) - offset) or 1.0
+        lut = numpy.zeros(256, numpy.float32)
+        known = numpy.zeros(256, bool)
+        for aa, value in zip(aas, values):
+            lut[[ord(aa.lower()), ord(aa.upper())]] = (value - offset) / scale
+            known[[ord(aa.lower()), ord(aa.upper())]] = True
+        sums = lut.take(self.msa.column_array).sum(axis=1)
+        counts = known.take(self.msa.column_array).sum(axis=1)
+        kernel = numpy.ones(min(self.window, len(sums)))
+        sums = numpy.convolve(sums, kernel, 'same')
+        counts = numpy.convolve(counts, kernel, 'same')
+        profile = sums / numpy.maximum(counts, 1)
+        self.profiles[key] = profile
+        return profile
+
+    def render(self, cr, area):
+        profile = self.get_profile()
+        if profile is None:
+            return
+        width = len(profile)
+        first_pos, x_offset = divmod(float(width * area.x) / area.total_width, 1)
+        first_pos = int(first_pos)
+        last_pos = min(int(width * float(area.x + area.width) / area.total_width), width - 1)
+        n_pos = min(last_pos - first_pos + 1, width)
+        cr.rectangle(0, 0, area.width, area.height)
+        cr.clip()
+        cr.translate(0, -area.y)
+        cr.set_source_rgba(*Color(215, 215, 215, self.alpha).rgba)
+        quartile_guidelines(cr, area.width, area.x, area.total_width, area.total_height)
+        bar(cr, self.gradient, self.alpha, profile, first_pos, n_pos, area.x, area.total_width, area.total_height)
+
+    def get_detail_size(self):
+        if not self.msa:
+            return 0, 0
+        return len(self.msa), 0
+
+    def get_tooltip(self, coord):
+        profile = self.get_profile()
+        if profile is None or coord.position is None:
+            return None
+        return 'Scale average: %.2f' % profile[coord.position]
+
+    def get_options(self):
+        return MSARenderer.get_options(self) + [GradientOption(self), ResidueScaleOption(self), IntOption(self, 'window', hint_maximum=50)]
+
+class ResidueScaleProfileSetting(ComponentSetting):
+    component_class = ResidueScaleProfile
+    setting_types = dict(alpha=FloatSetting,
+                         gradient=GradientSetting,
+                         scale=ResidueScaleSetting,
+                         window=IntSetting)
+
+presets.register_component_defaults(ResidueScaleProfileSetting)
+
 class Label(object):
     def __init__(self, text, font, color=None):
         if color is None:
@@ -784,8 +1384,6 @@ class Label(object):
     def __eq__(self, other):
         return other.text == self.text and other.font == self.font and other.color == self.color
 
-# TODO: get rid of the letter cache. It is unnecessay since cairo does such a gosh darned good job atrendering letters quickly anyway.
-
 class MSALetters(MSARenderer):
     __gproperties__ = dict(
         always_show = (
@@ -811,10 +1409,15 @@ class MSALetters(MSARenderer):
                         always_show=False,
                         color=presets.get_value('color:black'),
                         font=presets.get_setting('font:default'))
+    
+    thread_safe = True
+    
     def __init__(self):
         MSARenderer.__init__(self)
         self.pango_context = pangocairo.cairo_font_map_get_default().create_context()
-        self.cache = Cache()
+        self.cache = Cache(budget=cache_budget)
+        self._glyph_lock = threading.RLock()
+        self.render_lock = RenderLock()
         self._letter_size = None
         
     always_show = prop('always_show')
@@ -837,21 +1440,23 @@ class MSALetters(MSARenderer):
          
     def do_set_property(self, pspec, value):
         name = pspec.name.replace('-', '_')
-        if name in ['always_show', 'color', 'font']:
-            if value != getattr(self, name):
-                self.propvalues[name] = value
-                if name == 'font':
-                    self.update_letter_size()
-                else:
-                    self.emit('changed', Change('visualization'))
-            return
-        MSARenderer.do_set_property(self, pspec, value) 
+        with self.render_lock.writing():
+            if name in ['always_show', 'color', 'font']:
+                if value != getattr(self, name):
+                    self.propvalues[name] = value
+                    if name == 'font':
+                        self.update_letter_size()
+                    else:
+                        self.emit('changed', Change('visualization'))
+                return
+            MSARenderer.do_set_property(self, pspec, value) 
 
     @log.trace
     def handle_msa_change(self, msa, change):
         if not change.has_changed('sequences'):
             return
-        self.update_letter_size()
+        with self.render_lock.writing():
+            self.update_letter_size()
 
     def update_letter_size(self):
         self._letter_size = self.calculate_letter_size()
@@ -896,11 +1501,11 @@ class MSALetters(MSARenderer):
 
 
     def draw_letter(self, letter):
-        layout = pango.Layout(self.pango_context)
+        layout = pango.Layout(get_thread_pango_context())
         layout.set_font_description(letter.font)
         layout.set_text(letter.text)
         surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self._letter_size[0], self._letter_size[1])
-        cr = gtk.gdk.CairoContext(cairo.Context(surface))
+        cr = pangocairo.CairoContext(cairo.Context(surface))
         # The intricate return values from ...get_pixel_extents():
         #ink, logic = layout.get_line(0).get_pixel_extents()
         #ink_xbearing, ink_ybearing, ink_w, ink_h = ink
@@ -917,12 +1522,19 @@ class MSALetters(MSARenderer):
         return surface
 
     def get_letter_surface(self, letter):
-        try:
-            return self.cache[letter]
-        except:
-            l = self.draw_letter(letter)
-            self.cache[letter] = l
-            return l
+        """Return a pre-rendered glyph for the letter (a Label).
+        
+        Glyphs are cached on letter, font, color and cell size, so that 
+        raster rendering only needs to blit them into place.
+        """
+        key = (letter, self._letter_size[:2])
+        with self._glyph_lock:
+            try:
+                return self.cache[key]
+            except KeyError:
+                l = self.draw_letter(letter)
+                self.cache[key] = l
+                return l
         
     def get_letter(self, seq, pos, letter):
         font = self.get_font(seq, pos, letter)
@@ -930,13 +1542,39 @@ class MSALetters(MSARenderer):
         return Label(letter, font, color)
         
     def get_font(self, seq, pos, letter):
-        """Override in subclasses that want to vary fonts."""
+        """Override in subclasses that want to vary fonts.
+        
+        Subclasses that vary fonts from cell to cell (rather than from letter
+        to letter) must also override get_letter_groups().
+        """
         return self.font
 
     def get_color(self, seq, pos, letter):
-        """Override in subclasses that want to vary colorization."""
+        """Override in subclasses that want to vary colorization.
+        
+        Subclasses that vary colors from cell to cell (rather than from letter
+        to letter) must also override get_letter_groups().
+        """
         return self.color
     
+    def get_letter_groups(self, first_seq, n_seq, first_pos, n_pos):
+        """Group the cells in the given msa area by how they should be drawn.
+        
+        Yields (label, sequence_indices, position_indices) tuples, where the
+        index arrays hold the msa coordinates of all cells to be drawn with 
+        label. The default implementation assumes that fonts and colors only 
+        depend on the letter.
+        """
+        block = self.msa.sequence_array[first_seq:first_seq + n_seq, first_pos:first_pos + n_pos]
+        for code in numpy.unique(block):
+            if code == ord(' '):
+                # Padding for sequences shorter than the msa.
+                continue
+            seqs, positions = numpy.nonzero(block == code)
+            seqs += first_seq
+            positions += first_pos
+            yield self.get_letter(seqs[0], positions[0], chr(code)), seqs, positions
+        
     def render(self, cr, area):
         if self._letter_size is None:
             return
@@ -946,10 +1584,28 @@ class MSALetters(MSARenderer):
             return
         cr.rectangle(0, 0, area.width, area.height)
         cr.clip()
+        if vector_based(cr):
+            self.render_text(cr, area, first_pos, n_pos, xscale, first_seq, n_seq, yscale)
+            return
+        letter_width, letter_height = self._letter_size[:2]
+        xoffset = (xscale - letter_width)/2 - area.x
+        yoffset = (yscale - letter_height)/2 - area.y
+        for letter, seqs, positions in self.get_letter_groups(first_seq, n_seq, first_pos, n_pos):
+            glyph = self.get_letter_surface(Label(letter.text, letter.font, letter.color.with_alpha(self.alpha)))
+            xs = numpy.floor(positions * xscale + xoffset).astype(int).tolist()
+            ys = numpy.floor(seqs * yscale + yoffset).astype(int).tolist()
+            for x, y in zip(xs, ys):
+                cr.set_source_surface(glyph, x, y)
+                cr.rectangle(x, y, letter_width, letter_height)
+                cr.fill()
+    
+    def render_text(self, cr, area, first_pos, n_pos, xscale, first_seq, n_seq, yscale):
+        """Draw the letters as text, for vector based backends.""" 
         xoffset = xscale/2 - area.x
         yoffset = (yscale - self._letter_size[1])/2 - area.y
         cr.translate(xoffset, yoffset)
-        layout = pango.Layout(self.pango_context)
+        layout = pango.Layout(get_thread_pango_context())
+        letter_widths = {}
         for seq in range(first_seq, first_seq + n_seq): 
             sequence = self.msa.sequences[seq]
             for pos in range(first_pos, first_pos + n_pos):
@@ -958,21 +1614,19 @@ class MSALetters(MSARenderer):
                 except IndexError:
                     continue
                 letter = self.get_letter(seq, pos, aa)
-                # TODO: clean this up:
                 layout.set_font_description(letter.font)
                 layout.set_text(letter.text)
                 # The intricate return values from ...get_pixel_extents():
                 #ink, logic = layout.get_line(0).get_pixel_extents()
                 #ink_xbearing, ink_ybearing, ink_w, ink_h = ink
                 #log_xbearing, log_ybearing, log_w, log_h = logic
-                letter_width = layout.get_line(0).get_pixel_extents()[1][2]
-                # For debugging:
-                #cr.rectangle(0, 0, self._letter_size[0], self._letter_size[1])
-                #cr.stroke()
+                letter_width = letter_widths.get(letter)
+                if letter_width is None:
+                    letter_width = layout.get_line(0).get_pixel_extents()[1][2]
+                    letter_widths[letter] = letter_width
                 cr.move_to(pos * xscale - 0.5 * letter_width, seq * yscale)
                 cr.set_source_rgba(*letter.color.with_alpha(self.alpha).rgba)
                 cr.show_layout(layout)
-                    
     
     def get_slow_render(self, area):
         if not(self.msa):
@@ -1095,7 +1749,85 @@ class TransformList(object):
 
 # TODO: Label transform settings.
 
-# TODO: get rid of the label cache. It is unnecessay since cairo does such a gosh darned good job at rendering letters quickly anyway.
+class LabelMetrics(object):
+    """Pixel extents of label texts, remembered by font and text.
+    
+    If path is set, extents are also loaded from and saved to that file, so 
+    that labels need not be measured again in later sessions.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.extents = {}
+        self.modified = False
+        self._loaded_path = None
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        
+    def get_extents(self, font, text):
+        """Return (ink_width, ink_height, log_height) for text in font."""
+        key = (font.to_string(), text)
+        with self._lock:
+            if self.path != self._loaded_path:
+                self.load()
+            try:
+                return self.extents[key]
+            except KeyError:
+                pass
+        try:
+            layout = self._local.layout
+        except AttributeError:
+            layout = self._local.layout = pango.Layout(get_thread_pango_context())
+        layout.set_font_description(font)
+        layout.set_text(text)
+        # The intricate return values from ...get_pixel_extents():
+        #ink, logic = layout.get_line(0).get_pixel_extents()
+        #ink_xbearing, ink_ybearing, ink_w, ink_h = ink
+        #log_xbearing, log_ybearing, log_w, log_h = logic
+        ink_extents, log_extents = layout.get_line(0).get_pixel_extents()
+        extents = (ink_extents[2], ink_extents[3], log_extents[3])
+        with self._lock:
+            self.extents[key] = extents
+            self.modified = True
+        return extents
+    
+    def load(self):
+        self._loaded_path = self.path
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            f = open(self.path, 'rb')
+            try:
+                extents = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            return
+        extents.update(self.extents)
+        self.extents = extents
+        
+    def save(self):
+        with self._lock:
+            self._save()
+    
+    def _save(self):
+        if not self.path or not self.modified:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = open(self.path, 'wb')
+        try:
+            cPickle.dump(self.extents, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        self.modified = False
+
+USER_LABEL_METRICS_FILE = os.path.expanduser(os.path.join('~', '.msaview', 'label_metrics'))
+
+# Shared by all labelers. Set label_metrics.path (for example to 
+# USER_LABEL_METRICS_FILE) to keep measurements between sessions.
+label_metrics = LabelMetrics()
+atexit.register(label_metrics.save)
 
 class Labeler(Renderer):
     __gproperties__ = dict(
@@ -1133,12 +1865,21 @@ class Labeler(Renderer):
                         transform_labels=False,
                         resize_seqview_to_fit=False)
     
+    # Measure at most this many labels up front, and per idle callback.
+    measure_limit = 2000
+    # Memory budget for pre-rendered label surfaces.
+    label_cache_bytes = 16 * 2**20
+    
     def __init__(self):
         Renderer.__init__(self)
         self.pango_context = pangocairo.cairo_font_map_get_default().create_context()
-        self.cache = Cache()
+        self.cache = Cache(size=1000, max_bytes=self.label_cache_bytes, budget=cache_budget)
+        self._label_lock = threading.RLock()
+        self.render_lock = RenderLock()
         self._label_size = None
         self._label_widths = None
+        self._labels = None
+        self._measure_job = None
         
     color = prop('color')
     font = prop('font')
@@ -1164,14 +1905,16 @@ class Labeler(Renderer):
          
     def do_set_property(self, pspec, value):
         name = pspec.name.replace('-', '_')
-        if name in ['color', 'font', 'transform_labels', 'resize_seqview_to_fit', 'label_transforms']:
-            if value != getattr(self, name):
-                self.propvalues[name] = value
-                if name != 'color':
-                    self.update_label_size()
-                self.emit('changed', Change('visualization'))
-            return
-        Renderer.do_set_property(self, pspec, value) 
+        with self.render_lock.writing():
+            if name in ['color', 'font', 'transform_labels', 'resize_seqview_to_fit', 'label_transforms']:
+                if value != getattr(self, name):
+                    self.propvalues[name] = value
+                    self._labels = None
+                    if name != 'color':
+                        self.update_label_size()
+                    self.emit('changed', Change('visualization'))
+                return
+            Renderer.do_set_property(self, pspec, value) 
 
     def do_set_property_resize_seqview_to_fit(self, pspec, resize):
         # TODO: this seqview resize business needs neater implementation.
@@ -1182,49 +1925,101 @@ class Labeler(Renderer):
                 seqview.width_request = self._label_size[0] + 2
     
     def update_label_size(self):
-        self._label_size, self._label_widths = self.calculate_label_sizes()
+        with self.render_lock.writing():
+            self._labels = None
+            self._label_size, self._label_widths = self.calculate_label_sizes()
+        self.update_seqview_width()
+        self.emit('changed', Change('visualization'))
+    
+    def update_seqview_width(self):
         # TODO: this seqview resize business needs neater implementation, for example something like:
         #self.emit('changed', Change('width_request', data=self._label_size[0]))
         if self._label_size and self.resize_seqview_to_fit:
             seqview = self.find_ancestor('view.seq')
             if seqview:
                seqview.width_request = self._label_size[0] + 2
-        self.emit('changed', Change('visualization'))
     
     @log.trace    
     def calculate_label_sizes(self):
+        """Return label size (width, log_height, ink_height) and label widths.
+        
+        For many labels, only the labels in view and an evenly spaced sample
+        are measured up front. The widths of the rest are overestimated from 
+        the widest characters seen, and then measured in the background, which
+        updates the label size when done.
+        """
+        self.abort_label_measuring()
         data = self.get_data()
         if data is None or not len(data):
             return None, None
-        #return (100, 7, 5), [100] * len(data)
-        widths = []
-        ink_height = 0
-        log_height = 0
-        layout = pango.Layout(self.pango_context)
-        import time
-        get_label_time = 0.0
-        render_time = 0.0
-        t0 = time.time()
-        for i, x in enumerate(data):
-            t1 = time.time()
-            label = self.get_label(i, x)
-            t2 = time.time()
-            get_label_time += t2 - t1 
-            layout.set_font_description(label.font)
-            layout.set_text(label.text)
-            # The intricate return values from ...get_pixel_extents():
-            #ink, logic = layout.get_line(0).get_pixel_extents()
-            #ink_xbearing, ink_ybearing, ink_w, ink_h = ink
-            #log_xbearing, log_ybearing, log_w, log_h = logic
-            ink_extents, log_extents = layout.get_line(0).get_pixel_extents()
-            widths.append(ink_extents[2])
-            ink_height = max(ink_height, ink_extents[3])
-            log_height = max(log_height, log_extents[3])
-            render_time += time.time() - t2
-        self.logger.debug('get_label_time: %.3fs' % get_label_time)
-        self.logger.debug('render_time: %.3fs' % render_time)
-        width = max(widths) 
-        return (width, log_height, ink_height), widths
+        n_labels = len(data)
+        if n_labels <= self.measure_limit:
+            indices = range(n_labels)
+        else:
+            first, n_visible = self.get_visible_labels(n_labels)
+            indices = set(range(first, first + n_visible))
+            step = float(n_labels) / (self.measure_limit / 2)
+            indices.update(int(i * step) for i in range(self.measure_limit / 2))
+        widths = {}
+        log_height = ink_height = 0
+        char_width = 0.0
+        for i in indices:
+            font, text = self._get_font_and_text(i, data[i])
+            ink_width, ink_h, log_h = label_metrics.get_extents(font, text)
+            widths[i] = ink_width
+            ink_height = max(ink_height, ink_h)
+            log_height = max(log_height, log_h)
+            if text:
+                char_width = max(char_width, float(ink_width) / len(text))
+        if len(widths) < n_labels:
+            char_width = max(char_width, label_metrics.get_extents(self.font, 'W')[0])
+            estimates = [widths.get(i) for i in range(n_labels)]
+            for i, width in enumerate(estimates):
+                if width is None:
+                    estimates[i] = int(math.ceil(len(str(data[i])) * char_width))
+            self._measure_job = self.get_compute_manager().idle_add(self._measure_labels(data, estimates, widths, log_height, ink_height).next)
+            widths = estimates
+        else:
+            widths = [widths[i] for i in range(n_labels)]
+        return (max(widths), log_height, ink_height), widths
+
+    def get_visible_labels(self, n_labels):
+        """Return (first, count) for the labels in view, or the first ones if unknown."""
+        view = self.find_ancestor('view.seq')
+        adj = getattr(view, 'vadjustment', None)
+        if adj is None or not (adj.upper and adj.page_size):
+            return 0, min(n_labels, self.measure_limit)
+        first, count, scale = get_view_extents(adj.value, adj.page_size, adj.upper, n_labels)
+        return first, min(count, self.measure_limit)
+
+    def _get_font_and_text(self, i, x):
+        label = self.get_cached_label(i, x)
+        return label.font, label.text
+
+    def _measure_labels(self, data, estimates, measured, log_height, ink_height):
+        widths = list(estimates)
+        chunk = self.measure_limit
+        for start in range(0, len(data), chunk):
+            for i in range(start, min(start + chunk, len(data))):
+                if i not in measured:
+                    ink_width, ink_h, log_h = label_metrics.get_extents(*self._get_font_and_text(i, data[i]))
+                    widths[i] = ink_width
+                    ink_height = max(ink_height, ink_h)
+                    log_height = max(log_height, log_h)
+            yield True
+        self._measure_job = None
+        if estimates is self._label_widths:
+            with self.render_lock.writing():
+                self._label_size = (max(widths), log_height, ink_height)
+                self._label_widths = widths
+            self.update_seqview_width()
+            self.emit('changed', Change('visualization'))
+        yield False
+
+    def abort_label_measuring(self):
+        if self._measure_job is not None:
+            self.get_compute_manager().source_remove(self._measure_job)
+            self._measure_job = None
         
     def get_detail_size(self):
         if self._label_size is None:
@@ -1232,12 +2027,12 @@ class Labeler(Renderer):
         return 0, (self._label_size[2] + 1) * len(self.get_data())
 
     def draw_label(self, label):
-        layout = pango.Layout(self.pango_context)
+        layout = pango.Layout(get_thread_pango_context())
         layout.set_font_description(label.font)
         layout.set_text(label.text)
         label_width, label_height = layout.get_line(0).get_pixel_extents()[1][2:]
         surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, label_width, self._label_size[1])
-        cr = gtk.gdk.CairoContext(cairo.Context(surface))
+        cr = pangocairo.CairoContext(cairo.Context(surface))
         # For debugging:
         #cr.rectangle(0, 0, 0, self._label_height)
         #cr.stroke()
@@ -1248,16 +2043,29 @@ class Labeler(Renderer):
         return surface
 
     def get_label_surface(self, label):
-        try:
-            return self.cache[label]
-        except:
-            l = self.draw_label(label)
-            self.cache[label] = l
-            return l
+        key = (label, self._label_size[1])
+        with self._label_lock:
+            try:
+                return self.cache[key]
+            except KeyError:
+                l = self.draw_label(label)
+                self.cache[key] = l
+                return l
         
     def get_data(self):
         """Override to return something useful."""
     
+    def get_cached_label(self, i, data):
+        """Return get_label(i, data), remembered until the data or label properties change."""
+        with self._label_lock:
+            labels = self._labels
+            if labels is None:
+                labels = self._labels = [None] * len(self.get_data())
+            label = labels[i]
+            if label is None:
+                label = labels[i] = self.get_label(i, data)
+            return label
+    
     def get_label(self, i, data):
         """Override in subclasses that want to do fancy stuff to labels."""
         transform = self.get_transform(i, data)
@@ -1298,16 +2106,24 @@ class Labeler(Renderer):
         cr.clip()
         yoffset = int(yscale - self._label_size[1])/2 - area.y
         cr.translate(-area.x + 1, yoffset)
-        layout = pango.Layout(self.pango_context)
+        if not vector_based(cr):
+            for i in range(first_label, first_label + n_labels):
+                label = self.get_cached_label(i, data[i])
+                if not label.text:
+                    continue
+                surface = self.get_label_surface(Label(label.text, label.font, label.color.with_alpha(self.alpha)))
+                y = int(i * yscale)
+                cr.set_source_surface(surface, 0, y)
+                cr.rectangle(0, y, surface.get_width(), surface.get_height())
+                cr.fill()
+            return
+        layout = pango.Layout(get_thread_pango_context())
         for i in range(first_label, first_label + n_labels):
-            label = self.get_label(i, data[i])
+            label = self.get_cached_label(i, data[i])
             layout.set_font_description(label.font)
             layout.set_text(label.text)
             #label_width, label_height = layout.get_line(0).get_pixel_extents()[1][2:]
-            y = i * yscale
-            if not vector_based(cr):
-                y = int(y)
-            cr.move_to(0, y)
+            cr.move_to(0, i * yscale)
             cr.set_source_rgba(*label.color.with_alpha(self.alpha).rgba)
             cr.show_layout(layout)
 
@@ -1357,6 +2173,8 @@ class SequenceIDLabeler(Labeler):
     msaview_classname = 'renderer.seq.ids'
     logger = log.get_logger(msaview_classname)
     
+    thread_safe = True
+    
     def __init__(self):
         Labeler.__init__(self)
         self.propvalues['label_transforms'] = ABBREVIATE_KNOWN_ID_FORMATS
@@ -1839,6 +2657,12 @@ class SequenceFeatureColormapOption(Option):
         w.props.height_request = 200
         return w
     
+def get_color_steps(n):
+    """Return n evenly spaced gradient offsets from 0 to 1."""
+    if n < 2:
+        return [0.0] * n
+    return [float(i) / (n - 1) for i in range(n)]
+
 class SequenceFeatureMap(object):
     def __init__(self, color=None, colormapping=None, features=None, hash=None):
         self.color = color
@@ -1847,6 +2671,7 @@ class SequenceFeatureMap(object):
             features = []
         self.features = features
         self.hash = hash
+        self.index = None
 
     def __hash__(self):
         if not self.is_frozen():
@@ -1859,18 +2684,21 @@ class SequenceFeatureMap(object):
     def freeze(self):
         self.features = tuple(self.features)
         self.hash = hash((self.color, self.features))
+        index = {}
+        for feature in self.features:
+            index.setdefault(feature.sequence_index, []).append(feature)
+        self.index = dict((i, IntervalIndex(l)) for i, l in index.items())
         
     def is_frozen(self):
         return self.hash is not None
     
     def get_features(self, coord):
-        features = []
-        for feature in self.features:
-            if feature.sequence_index > coord.sequence:
-                break
-            if feature.sequence_index == coord.sequence and coord.position in feature.mapping:
-                features.append(feature)
-        return features
+        if self.index is None:
+            return [f for f in self.features if f.sequence_index == coord.sequence and coord.position in f.mapping]
+        index = self.index.get(coord.sequence)
+        if index is None:
+            return []
+        return index.at(coord.position)
 
 class BasicSequenceFeatureRenderer(Renderer):
     """Renderer with basic functionality to react to changes in sequence features."""
@@ -1971,6 +2799,7 @@ class SequenceFeatureRenderer(BasicSequenceFeatureRenderer):
         BasicSequenceFeatureRenderer.__init__(self)
         self.image = None
         self.array = None
+        self._pyramid = None
         # TODO: Find better way of finding letter size and put here.
         self.propvalues['cell_size'] = (-1, -1)
     
@@ -2013,6 +2842,8 @@ class SequenceFeatureRenderer(BasicSequenceFeatureRenderer):
             return None, None
         # Match features to colormap rules and determine number of needed gradient generated colors
         features = [[[]] for mapping in self.colormap.mappings]
+        # Indices into features of the lists of similarly annotated features.
+        groups = [{} for mapping in self.colormap.mappings]
         for feature in itertools.chain(*feature_registry.features):
             i = len(self.colormap.mappings)
             for rule in reversed(self.colormap.mappings):
@@ -2024,12 +2855,13 @@ class SequenceFeatureRenderer(BasicSequenceFeatureRenderer):
                 if rule.group:
                     features[i][0].append(feature)
                 else:
-                    for feature_list in features[i]:
-                        if not feature_list or feature.equal(feature_list[0]):
-                            feature_list.append(feature)
-                            break
-                    else:
-                        features[i].append([feature])
+                    key = feature.get_annotation_key()
+                    j = groups[i].get(key)
+                    if j is None:
+                        j = groups[i][key] = len(groups[i])
+                        if j:
+                            features[i].append([])
+                    features[i][j].append(feature)
                 break
         # Finalize colors and draw order, and build feature maps
         feature_maps = []
@@ -2037,10 +2869,8 @@ class SequenceFeatureRenderer(BasicSequenceFeatureRenderer):
             if not matching_feature_lists[0]:
                 continue
             colormapping = self.colormap.mappings[i]
-            last_step = float(len(matching_feature_lists)) - 1
-            for color_step, feature_list in enumerate(matching_feature_lists):
-                offset = color_step / last_step if last_step else 0 
-                color = colormapping.gradient.get_color_from_offset(offset)
+            colors = colormapping.gradient.get_colors_from_offsets(get_color_steps(len(matching_feature_lists)))
+            for color, feature_list in zip(colors, matching_feature_lists):
                 feature_maps.append(SequenceFeatureMap(color, colormapping, feature_list))
         for feature_map in feature_maps:
             feature_map.sort()
@@ -2051,11 +2881,13 @@ class SequenceFeatureRenderer(BasicSequenceFeatureRenderer):
         height = len(feature_registry.msa.sequences)
         image = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
         image.flush()
-        array = numpy.frombuffer(image.get_data(), dtype=numpy.uint8)
+        array = numpy.frombuffer(image.get_data(), numpy.uint8)
         array.shape = (height, width, -1)
         for feature_map in feature_maps:
+            color = feature_map.color.array
             for feature in feature_map.features:
-                array[feature.sequence_index, feature.mapping.start:feature.mapping.start+feature.mapping.length] = feature_map.color.array
+                start = feature.mapping.start
+                array[feature.sequence_index, start:start + feature.mapping.length] = color
         image.mark_dirty()
         return image, feature_maps
         
@@ -2071,7 +2903,8 @@ class SequenceFeatureRenderer(BasicSequenceFeatureRenderer):
             return 
         detail = self.get_detail_size()
         if area.total_width < detail[0] or area.total_height < detail[1]:
-            scaled_image(cr, area, self.image, self.alpha)
+            self._pyramid = get_image_pyramid(self._pyramid, self.image)
+            self._pyramid.render(cr, area, self.alpha)
         else:
             for feature_map in self.feature_map:
                 c = feature_map.color
@@ -2079,18 +2912,20 @@ class SequenceFeatureRenderer(BasicSequenceFeatureRenderer):
                     c = feature_map.color.with_alpha(self.alpha)
                 outlined_regions(cr, area, len(self.features.msa), len(self.features.msa.sequences), feature_map.features, self.linewidth, c, self.alpha, False)
 
+    def get_scaled_image(self, area):
+        if not self.image:
+            return None
+        detail = self.get_detail_size()
+        if area.total_width < detail[0] or area.total_height < detail[1]:
+            return self.image, self.alpha
+        return None
+
     def get_tooltip(self, coord):
         if not self.feature_map:
             return
         descriptions = []
         for map in self.feature_map:
-            for feature in map.features:
-                if feature.sequence_index < coord.sequence:
-                    continue
-                if feature.sequence_index > coord.sequence or feature.mapping.start > coord.position:
-                    break
-                if coord.position >= feature.mapping.start + feature.mapping.length:
-                    continue
+            for feature in map.get_features(coord):
                 descriptions.append(feature.to_markup(map.color))
         if descriptions:
             return 'Features: ' + ', '.join(descriptions)
@@ -2156,6 +2991,7 @@ class SequenceFeatureSummary(object):
             tracks = []
         self.tracks = tracks
         self.hash = hash
+        self.track_starts = None
 
     def __hash__(self):
         if not self.is_frozen():
@@ -2165,34 +3001,48 @@ class SequenceFeatureSummary(object):
     def __nonzero__(self):
         return bool(self.tracks)
     
-    def add_blob(self, blob):
-        for track in self.tracks:
-            if blob.region.start + blob.region.length <= track[0].region.start:
-                track.insert(0, blob)
-                return
-            for i in range(len(track)):
-                if blob.region.start < track[i].region.start + track[i].region.length:
-                    continue
-                if (i == len(track) - 1 or
-                    blob.region.start + blob.region.length <= track[i + 1].region.start):
-                    track.insert(i + 1, blob)
-                    return
-        self.tracks.append([blob])
+    def add_blobs(self, blobs):
+        """Pack blobs into tracks so that blobs in a track do not overlap.
+        
+        Sweeps the blobs in start order with a min-heap of occupied track ends
+        and a min-heap of free track indices, so each blob goes in the topmost
+        track that is free at its start, in O(n log n). Blobs starting at the 
+        same position are placed in the order given. New blobs go after the
+        ones already in a track.
+        """
+        self.tracks = [list(t) for t in self.tracks]
+        ends = [(max(b.region.start + b.region.length for b in t), i) for i, t in enumerate(self.tracks) if t]
+        heapq.heapify(ends)
+        free = [i for i, t in enumerate(self.tracks) if not t]
+        order = sorted(range(len(blobs)), key=lambda i: (blobs[i].region.start, i))
+        for i in order:
+            blob = blobs[i]
+            start = blob.region.start
+            while ends and ends[0][0] <= start:
+                heapq.heappush(free, heapq.heappop(ends)[1])
+            if free:
+                track = heapq.heappop(free)
+            else:
+                track = len(self.tracks)
+                self.tracks.append([])
+            self.tracks[track].append(blob)
+            heapq.heappush(ends, (start + blob.region.length, track))
     
     def freeze(self):
         self.tracks = tuple(tuple(t) for t in self.tracks)
         self.hash = hash(self.tracks)
+        self.track_starts = tuple([blob.region.start for blob in t] for t in self.tracks)
         
     def is_frozen(self):
         return self.hash is not None
     
     def get_blob(self, coord):
-        i = int(float(coord.y) / coord.total_height * len(self.tracks))
-        for blob in self.tracks[i]:
-            if blob.region.start > coord.position:
-                return
-            if coord.position in blob.region:
-                return blob
+        i = min(int(float(coord.y) / coord.total_height * len(self.tracks)), len(self.tracks) - 1)
+        # Blobs within a track do not overlap, so only the last one starting
+        # at or before the position can contain it.
+        j = bisect.bisect_right(self.track_starts[i], coord.position) - 1
+        if j >= 0 and coord.position in self.tracks[i][j].region:
+            return self.tracks[i][j]
 
 class SequenceFeatureSummaryRenderer(BasicSequenceFeatureRenderer):
     __gproperties__ = dict(
@@ -2231,26 +3081,26 @@ class SequenceFeatureSummaryRenderer(BasicSequenceFeatureRenderer):
         options = [SequenceFeatureColormapOption(self)]
         return BasicSequenceFeatureRenderer.get_options(self) + options  
 
+    def make_blobs(self, features):
+        """Merge features with overlapping mappings into blobs, ordered by start."""
+        blobs = []
+        end = None
+        for feature in sorted(features, key=lambda f: f.mapping.start):
+            if blobs and feature.mapping.start < end:
+                blob.add_feature(feature)
+            else:
+                region = Region(feature.mapping.start, feature.mapping.length)
+                blob = SequenceFeatureSummaryBlob(region=region, features=[feature])
+                blobs.append(blob)
+            end = blob.region.start + blob.region.length
+        return blobs
+        
     def colorize(self, feature_registry):
         if not feature_registry.features or not self.colormap.mappings:
             return None
-        def update_blob_list(blob_list, feature):
-            for i in range(len(blob_list)):
-                blob = blob_list[i]
-                if feature.mapping.start + feature.mapping.length <= blob.region.start:
-                    region = Region(feature.mapping.start, feature.mapping.length)
-                    blob_list.insert(i, SequenceFeatureSummaryBlob(region=region, features=[feature]))
-                    return
-                if blob.region.overlap(feature.mapping):
-                    blob.add_feature(feature)
-                    if i < len(blob_list) - 1:
-                        if blob.region.overlap(blob_list[i + 1].region):
-                            blob.merge(blob_list.pop(i + 1))
-                    return
-            region = Region(feature.mapping.start, feature.mapping.length)
-            blob_list.append(SequenceFeatureSummaryBlob(region=region, features=[feature]))
-        # Create blobs according to colormap rules and determine number of needed gradient generated colors
-        mapping_blob_lists = [[[]] for mapping in self.colormap.mappings]
+        # Sort features according to colormap rules and determine number of needed gradient generated colors
+        mapping_feature_lists = [[[]] for mapping in self.colormap.mappings]
+        groups = [{} for mapping in self.colormap.mappings]
         for feature in itertools.chain(*feature_registry.features):
             i = len(self.colormap.mappings)
             for rule in reversed(self.colormap.mappings):
@@ -2260,31 +3110,30 @@ class SequenceFeatureSummaryRenderer(BasicSequenceFeatureRenderer):
                 if rule.suppress:
                     break
                 if rule.group:
-                    update_blob_list(mapping_blob_lists[i][0], feature)
+                    mapping_feature_lists[i][0].append(feature)
                     break
                 else:
-                    for blob_list in mapping_blob_lists[i]:
-                        if not blob_list or feature.equal(blob_list[0].features[0]):
-                            update_blob_list(blob_list, feature)
-                            break
-                    else:
-                        new_blob_list = []
-                        update_blob_list(new_blob_list, feature)
-                        mapping_blob_lists[i].append(new_blob_list)
+                    key = feature.get_annotation_key()
+                    j = groups[i].get(key)
+                    if j is None:
+                        j = groups[i][key] = len(groups[i])
+                        if j:
+                            mapping_feature_lists[i].append([])
+                    mapping_feature_lists[i][j].append(feature)
                 break
-        # Finalize colors and pack blobs into tracks
-        feature_map = SequenceFeatureSummary()
+        # Merge features into blobs, finalize colors and pack blobs into tracks
+        blobs = []
         for i, rule in enumerate(self.colormap.mappings):
-            last_step = float(len(mapping_blob_lists[i])) - 1
-            for color_step, blob_list in enumerate(mapping_blob_lists[i]):
-                offset = color_step / last_step if last_step else 0 
-                color = rule.gradient.get_color_from_offset(offset)
-                for blob in blob_list:
+            colors = rule.gradient.get_colors_from_offsets(get_color_steps(len(mapping_feature_lists[i])))
+            for color, feature_list in zip(colors, mapping_feature_lists[i]):
+                for blob in self.make_blobs(feature_list):
                     blob.color = color
                     blob.colormapping = rule
                     blob.sort()
                     blob.freeze()
-                    feature_map.add_blob(blob)
+                    blobs.append(blob)
+        feature_map = SequenceFeatureSummary()
+        feature_map.add_blobs(blobs)
         feature_map.freeze()
         return feature_map
 
@@ -2564,6 +3413,27 @@ def get_ticks(start, items_in_view, tick_hint=9):
     stop = scaled_step * int(divmod(start + items_in_view, scaled_step)[0] + 1)
     return first, stop, scaled_step
 
+class FusedImages(object):
+    """Stands in for a run of renderers whose (image, alpha) layers have been 
+    composited into one image, so that they can be drawn with one scaled blit.
+    """
+    def __init__(self, layers, key=None):
+        self.image = composite_images(layers)
+        self.key = key
+        # For the byte count of the composite cache.
+        self.nbytes = get_nbytes(self.image)
+        self._pyramid = None
+        
+    def get_cache_key(self):
+        return (FusedImages, self.key)
+        
+    def render(self, cr, area):
+        self._pyramid = get_image_pyramid(self._pyramid, self.image)
+        self._pyramid.render(cr, area, 1.0)
+        
+    def get_slow_render(self, area):
+        return False
+
 class RendererStack(Component):
     __gproperties__ = dict(
         renderers = (
@@ -2572,11 +3442,18 @@ class RendererStack(Component):
             'the renderers that will be drawn on top of each other',
             gobject.PARAM_READWRITE))
     
+    # Images larger than this are drawn one by one rather than composited.
+    max_fused_bytes = 128 * 2**20
+    
     def __init__(self, renderers=None):
         Component.__init__(self)
         if renderers is None:
             renderers = []
         self.renderers = renderers
+        self.fuse_images = True
+        # Kept out of the shared budget, which would otherwise evict composites
+        # that are in use and have them rebuilt for every fragment.
+        self._fused = Cache(size=2)
     
     renderers = prop('renderers')
         
@@ -2597,8 +3474,54 @@ class RendererStack(Component):
         r = reduce(lambda l, r: (l << 2) ^ r, (hash(t) for t in enumerate(self.renderers)), hash(self.__class__))
         return r
     
+    def get_cache_key(self):
+        # The renderer list is modified in place by views, without emitting.
+        return Component.get_cache_key(self) + tuple(r.get_cache_key() for r in self.renderers)
+    
+    def get_render_steps(self, area):
+        """Return a list of (renderer index, renderer) to draw for area, in order.
+        
+        If fuse_images is set, runs of two or more renderers that would only 
+        paint equally sized images scaled to the area are replaced by one 
+        FusedImages step, listed under the index of the first of them. A few
+        recently used composites are kept, keyed on the cache keys of their 
+        renderers. Images over max_fused_bytes are not fused.
+        """
+        if not self.fuse_images:
+            return list(enumerate(self.renderers))
+        steps = []
+        run = []
+        def flush_run():
+            if len(run) > 1:
+                key = tuple((r.get_cache_key(), alpha) for i, r, (image, alpha) in run)
+                step = self._fused.get(key)
+                if step is None:
+                    step = self._fused[key] = FusedImages([layer for i, r, layer in run], key)
+                steps.append((run[0][0], step))
+            else:
+                steps.extend((i, r) for i, r, layer in run)
+            del run[:]
+        def get_size(image):
+            return image.get_width(), image.get_height()
+        for i, r in enumerate(self.renderers):
+            layer = r.get_scaled_image(area)
+            if layer is not None and get_nbytes(layer[0]) > self.max_fused_bytes:
+                layer = None
+            if run and (layer is None or get_size(layer[0]) != get_size(run[0][2][0])):
+                flush_run()
+            if layer is None:
+                steps.append((i, r))
+            else:
+                run.append((i, r, layer))
+        flush_run()
+        return steps
+        
     def render(self, cr, area):
-        for r in self.renderers:
+        if vector_based(cr):
+            steps = enumerate(self.renderers)
+        else:
+            steps = self.get_render_steps(area)
+        for i, r in steps:
             cr.save()
             r.render(cr, area)
             cr.restore()
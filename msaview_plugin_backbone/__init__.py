@@ -41,20 +41,19 @@ THE SOFTWARE.
 __version__ = "0.9.0"
 
 import msaview
+import numpy
 
 from msaview.component import Change
 from msaview.plotting import vector_based
-from msaview.selection import Region 
-from msaview.features import (ContiguousRegion, 
-                              make_regions)
 from msaview.renderers import MSARenderer
 
 class BackboneRenderer(MSARenderer):
 
     def __init__(self):
         msaview.renderers.MSARenderer.__init__(self)
-        self.backbones = None
-        self.gaps = None
+        self.starts = None
+        self.ends = None
+        self.offsets = None
         
     msaview_classname = 'renderer.msa.backbone'
     
@@ -62,25 +61,25 @@ class BackboneRenderer(MSARenderer):
         if not change.has_changed('sequences'):
             return
         if msa.ungapped is None:
-            self.backbones = None
-            self.gaps = None
+            self.starts = None
+            self.ends = None
+            self.offsets = None
             return
-        self.backbones = [ContiguousRegion(make_regions(u, bool)) for u in msa.ungapped]
-        self.gaps = []
-        for backbone in self.backbones:
-            gap_parts = []
-            previous = None
-            for part in backbone.parts:
-                if previous is None:
-                    previous = part
-                    continue
-                gap_start = previous.start + previous.length
-                gap_parts.append(Region(gap_start, part.start - gap_start))
-            self.gaps.append(ContiguousRegion(gap_parts))
+        # Runs of ungapped positions for all rows, as flat arrays of starts 
+        # and (exclusive) ends in row major order. The runs for row i are 
+        # found at offsets[i]:offsets[i+1], and the gaps between them span 
+        # from each end to the following start.
+        n_sequences, length = msa.ungapped.shape
+        padded = numpy.zeros((n_sequences, length + 2), dtype=numpy.int8)
+        padded[:,1:-1] = msa.ungapped
+        steps = numpy.diff(padded, axis=1)
+        rows, self.starts = numpy.nonzero(steps == 1)
+        self.ends = numpy.nonzero(steps == -1)[1]
+        self.offsets = numpy.searchsorted(rows, numpy.arange(n_sequences + 1))
         self.emit('changed', Change('visualization'))
         
     def render(self, cr, area):
-        if not self.backbones:
+        if self.starts is None or not len(self.starts):
             return
         if (area.total_width < len(self.msa) or
             area.total_height < len(self.msa.sequences)):
@@ -88,21 +87,27 @@ class BackboneRenderer(MSARenderer):
             pass
         raster_backend = not vector_based(cr)
         msa_area = area.msa_area(self.msa)
-        def draw_lines(contiguous_regions, linewidth):
+        first_pos = msa_area.positions.start
+        last_pos = msa_area.positions.start + msa_area.positions.length
+        xscale = float(area.total_width) / len(self.msa)
+        def draw_lines(gaps, linewidth):
             for seq in range(msa_area.sequences.start, msa_area.sequences.start + msa_area.sequences.length):
                 y = (seq + 0.5) / len(self.msa.sequences) * area.total_height - area.y
                 if raster_backend:
                     y = int(y - linewidth / 2) + linewidth / 2
-                for region in contiguous_regions[seq].parts:
-                    if region.start + region.length < msa_area.positions.start:
-                        continue
-                    if region.start > msa_area.positions.start + msa_area.positions.length:
-                        break
-                    x_start = float(region.start) / len(self.msa) * area.total_width - area.x
-                    x_stop = float(region.start + region.length) / len(self.msa) * area.total_width - area.x
-                    if raster_backend:
-                        x_start = int(x_start)
-                        x_stop = int(x_stop)
+                starts = self.starts[self.offsets[seq]:self.offsets[seq + 1]]
+                ends = self.ends[self.offsets[seq]:self.offsets[seq + 1]]
+                if gaps:
+                    starts, ends = ends[:-1], starts[1:]
+                # Only segments that intersect the visible positions.
+                lo = numpy.searchsorted(ends, first_pos)
+                hi = numpy.searchsorted(starts, last_pos, 'right')
+                x_starts = starts[lo:hi] * xscale - area.x
+                x_stops = ends[lo:hi] * xscale - area.x
+                if raster_backend:
+                    x_starts = x_starts.astype(int)
+                    x_stops = x_stops.astype(int)
+                for x_start, x_stop in zip(x_starts.tolist(), x_stops.tolist()):
                     cr.move_to(x_start, y)
                     cr.line_to(x_stop, y)
         linewidth = min(2, max(10, float(area.total_height) / len(self.msa.sequences) / 2))
@@ -115,11 +120,11 @@ class BackboneRenderer(MSARenderer):
         cr.save()
         cr.set_line_width(linewidth/2)
         cr.set_dash([1, 1])
-        draw_lines(self.gaps, int(linewidth/2))
+        draw_lines(True, int(linewidth/2))
         cr.stroke()
         cr.restore()
         cr.set_line_width(linewidth)
-        draw_lines(self.backbones, linewidth)
+        draw_lines(False, linewidth)
         cr.stroke()
         cr.restore()
             
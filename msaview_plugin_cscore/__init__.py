@@ -63,8 +63,8 @@ from msaview.preset import (BoolSetting,
                             presets)
 from msaview.options import GradientOption
 from msaview.plotting import (bar,
+                              get_image_pyramid,
                               quartile_guidelines,
-                              scaled_image, 
                               scaled_image_rectangles, 
                               vector_based, 
                               v_bar, 
@@ -398,6 +398,7 @@ class DivergenceRenderer(Renderer):
     def __init__(self):
         Renderer.__init__(self)
         self.array = None
+        self._pyramid = None
 
     gradient = prop('gradient') 
     cscore = prop('cscore') 
@@ -456,21 +457,9 @@ class DivergenceRenderer(Renderer):
             _cscore.divergences_renderer_colorize(arr, divergences, self.gradient)
             image.mark_dirty()
             return image
-        column_array = self.cscore.msa.column_array
-        arr = numpy.empty(column_array.shape + (4,), numpy.uint8)
-        colormap = numpy.empty((256, 4), numpy.uint8)
-        lookup = self.gradient.get_array_from_offset
-        divs = self.cscore.divs
-        for pos in range(arr.shape[0]):
-            unknown = divs[pos, 0]
-            colormap[:] = self.gradient.get_array_from_offset(unknown)
-            for i in numpy.nonzero(divs[pos] != unknown)[0]:
-                colormap[i] = lookup(divs[pos, i]) 
-            arr[pos] = colormap[column_array[pos]]
-        image = cairo.ImageSurface(cairo.FORMAT_ARGB32, column_array.shape[0], column_array.shape[1])
-        b = numpy.frombuffer(arr.data, numpy.int32)
-        b.shape = arr.shape[:-1]
-        image.get_data()[:] = b.T.tostring()
+        arr = numpy.frombuffer(image.get_data(), dtype=numpy.uint8)
+        arr.shape = (divergences.shape[0], divergences.shape[1], -1)
+        arr[:] = self.gradient.map_array(divergences)
         image.mark_dirty()
         return image
 
@@ -480,7 +469,13 @@ class DivergenceRenderer(Renderer):
         if vector_based(cr):
             scaled_image_rectangles(cr, area, self.array, self.alpha)
         else:
-            scaled_image(cr, area, self.image, self.alpha)
+            self._pyramid = get_image_pyramid(self._pyramid, self.image)
+            self._pyramid.render(cr, area, self.alpha)
+
+    def get_scaled_image(self, area):
+        if self.image is None:
+            return None
+        return self.image, self.alpha
 
     def get_options(self):
         return Renderer.get_options(self) + [GradientOption(self)]
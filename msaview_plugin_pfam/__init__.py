@@ -272,7 +272,7 @@ class ShowDomainInPfamWebInterface(Action):
             return
         if target.msaview_classname != 'data.msa':
             return
-        feature = target.features.find(lambda f: f.source.startswith('Pfam') and coord.position in f.mapping, coord.sequence)
+        feature = target.features.find(lambda f: f.source.startswith('Pfam'), coord.sequence, coord.position)
         if not feature:
             return
         a = cls(target, coord)
@@ -93,9 +93,9 @@ except:
         def get_alphabet(self):
             return self.alphabet
         def get_alphabet_index(self, aa):
-            return self.alphabet.index[aa]
+            return self.alphabet.index(aa)
         def lookup(self, aa1, aa2):
-            return self.scores[self.alphabet.index[aa1]][self.alphabet.index[aa2]]
+            return self.scores[self.alphabet.index(aa1)][self.alphabet.index(aa2)]
     def get_matrix(name):
         if name.lower() != 'blosum62':
             raise NotImplementedError('only blosum62 is supported without substitution_matrix backend extension module')